@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+
+import core
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+import metrics
+from metrics import span
+from concurrency import CALL_TIMEOUT
+from cache import image_cache_key
+from images import preprocess_image_data, read_image_data
+from near_duplicates import image_phash
+from prescreen import ImageRejected, healthy_diagnosis, screen_image
+from prompts import CROP_SUGGESTIONS, REGIONAL_INSIGHTS, TRANSLATION
+from resilience import error_status
+from responses import clean_response_text
+from structured import dumps_compact, parse_crops, parse_diagnosis, render_crops, render_diagnosis
+from translation import (
+    analysis_language, localized_diagnosis, needs_translation, translate_diagnosis_json, translation_prompt
+)
+from generation import (
+    DISEASE_PROMPT_VERSION, crop_suggestions_prompt, diagnosis_cache, disease_analysis_prompt,
+    disease_analysis_template, generate_regional_disease_insights, get_crop_suggestions, model,
+    near_duplicates, precomputed_insights, regional_insights_prompt
+)
+
+# Async serving mode: the same JSON contracts as test1.py, but upstream calls
+# are awaited on an event loop, so one process can keep thousands of them in
+# flight. ASGI_MAX_CONCURRENCY caps concurrent upstream calls per process.
+#
+#     uvicorn asgi_app:app --workers 2
+ASGI_MAX_CONCURRENCY = int(os.getenv("ASGI_MAX_CONCURRENCY", "1000"))
+
+upstream_slots = asyncio.Semaphore(ASGI_MAX_CONCURRENCY)
+
+async def generate(contents, endpoint=None):
+    async with upstream_slots:
+        return await model.generate_content_async(contents, endpoint=endpoint)
+
+# Core Functions. Cache and store lookups can be SQLite reads and writes,
+# so they run on threads too.
+async def analyse_image(image_bytes, language, district, state, area):
+    with span("read_image"):
+        image_data = read_image_data(image_bytes)
+    cache_key = image_cache_key(
+        image_data["data"], language, district, state, area, DISEASE_PROMPT_VERSION
+    )
+    cached = await asyncio.to_thread(diagnosis_cache.get, cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    # Decoding, screening and resizing are CPU work; keep them off the event loop
+    with span("prescreen"):
+        screening = await asyncio.to_thread(screen_image, image_data["data"])
+    if screening is not None and screening["verdict"] == "healthy":
+        return healthy_diagnosis(screening)
+    
+    # Hash the downscaled copy the model gets, not the full upload
+    with span("preprocess"):
+        image_data = await asyncio.to_thread(preprocess_image_data, image_data)
+    
+    group = (language, district, state, area, DISEASE_PROMPT_VERSION)
+    with span("phash_lookup"):
+        image_hash = await asyncio.to_thread(image_phash, image_data["data"], screening)
+        similar_key = near_duplicates.get(image_hash, group) if image_hash is not None else None
+    cached = await asyncio.to_thread(diagnosis_cache.get, similar_key) if similar_key else None
+    if cached is not None:
+        return json.loads(cached)
+    
+    async def diagnose():
+        template = disease_analysis_template(district, state, area)
+        language_prompt = disease_analysis_prompt(language, district, state, area)
+        with span("vision_call"):
+            response = await generate([language_prompt, image_data], template.endpoint)
+        return dumps_compact(parse_diagnosis(response.text))
+    
+    # One call per image across requests and workers, as in test1.py
+    diagnosis = json.loads(await diagnosis_cache.get_or_compute_async(cache_key, diagnose))
+    if image_hash is not None:
+        near_duplicates.add(image_hash, group, cache_key)
+    return diagnosis
+
+async def translate_diagnosis_async(diagnosis, language):
+    if not needs_translation(diagnosis, language):
+        return diagnosis
+    diagnosis_json = dumps_compact(diagnosis)
+    translated = await asyncio.to_thread(translate_diagnosis_json.lookup, diagnosis_json, language)
+    if translated is None:
+        with span("translate_call"):
+            response = await generate([translation_prompt(diagnosis_json, language)], TRANSLATION.endpoint)
+        translated = parse_diagnosis(response.text)
+        await asyncio.to_thread(translate_diagnosis_json.store, translated, diagnosis_json, language)
+    return localized_diagnosis(diagnosis, translated)
+
+async def get_disease_diagnosis(image_bytes, language, district, state, area):
+    diagnosis = await analyse_image(image_bytes, analysis_language(language), district, state, area)
+    return await translate_diagnosis_async(diagnosis, language)
+
+def cached_regional_insights(district, state, area):
+    return precomputed_insights(district, state, area) or generate_regional_disease_insights.lookup(
+        district, state, area
+    )
+
+async def get_regional_disease_insights_async(district, state, area):
+    cached = await asyncio.to_thread(cached_regional_insights, district, state, area)
+    if cached is not None:
+        return cached
+
+    with span("regional_call"):
+        response = await generate([regional_insights_prompt(district, state, area)], REGIONAL_INSIGHTS.endpoint)
+    insights = clean_response_text(response.text)
+    await asyncio.to_thread(generate_regional_disease_insights.store, insights, district, state, area)
+    return insights
+
+async def get_crop_suggestions_async(soil_type, ph_level, nutrients, texture, location):
+    args = (soil_type, ph_level, nutrients, texture, location)
+    cached = await asyncio.to_thread(get_crop_suggestions.lookup, *args)
+    if cached is not None:
+        return cached
+
+    with span("crop_call"):
+        response = await generate([crop_suggestions_prompt(*args)], CROP_SUGGESTIONS.endpoint)
+    suggestions = parse_crops(response.text)
+    await asyncio.to_thread(get_crop_suggestions.store, suggestions, *args)
+    return suggestions
+
+def upstream_error_response(errors):
+    # Same status codes and Retry-After as test1.py
+    messages = {name: str(e) for name, e in errors.items()}
+    status, headers = error_status(errors.values())
+    return JSONResponse(
+        {"error": "; ".join(messages.values()), "errors": messages}, status_code=status, headers=headers
+    )
+
+# Routes
+async def disease_detection_api(request):
+    form = await request.form()
+    image = form.get('image')
+    if image is None or isinstance(image, str):
+        return JSONResponse({"error": "No image uploaded"}, status_code=400)
+
+    params = {
+        'language': form.get('language', 'English'),
+        'district': form.get('district', ''),
+        'state': form.get('state', ''),
+        'area': form.get('area', '')
+    }
+    image_bytes = await image.read()
+
+    names = ["disease_analysis", "regional_insights"]
+    outcomes = await asyncio.gather(
+        asyncio.wait_for(get_disease_diagnosis(
+            image_bytes, params['language'], params['district'], params['state'], params['area']
+        ), CALL_TIMEOUT),
+        asyncio.wait_for(get_regional_disease_insights_async(
+            params['district'], params['state'], params['area']
+        ), CALL_TIMEOUT),
+        return_exceptions=True,
+    )
+
+    if isinstance(outcomes[0], ImageRejected):
+        return JSONResponse({"error": str(outcomes[0])}, status_code=422)
+    
+    results, errors = {}, {}
+    for name, outcome in zip(names, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            errors[name] = TimeoutError(f"Timed out after {CALL_TIMEOUT:g} seconds")
+        elif isinstance(outcome, Exception):
+            errors[name] = outcome
+        else:
+            results[name] = outcome
+
+    if not results:
+        return upstream_error_response(errors)
+
+    diagnosis = results.get("disease_analysis")
+    response = {
+        "disease_analysis": render_diagnosis(diagnosis, params['language']) if diagnosis else None,
+        "diagnosis": diagnosis,
+        "regional_insights": results.get("regional_insights"),
+    }
+    if errors:
+        response["errors"] = {name: str(e) for name, e in errors.items()}
+    return JSONResponse(response)
+
+async def crop_recommendation_api(request):
+    data = await request.json()
+
+    required_fields = ['soil_type', 'ph_level', 'nutrients', 'texture', 'location']
+    for field in required_fields:
+        if field not in data:
+            return JSONResponse({"error": f"Missing {field}"}, status_code=400)
+
+    try:
+        suggestions = await asyncio.wait_for(get_crop_suggestions_async(
+            data['soil_type'], data['ph_level'], data['nutrients'], data['texture'], data['location']
+        ), CALL_TIMEOUT)
+    except Exception as e:
+        return upstream_error_response({"recommendations": e})
+
+    return JSONResponse({
+        "recommendations": render_crops(suggestions),
+        "crops": suggestions["crops"],
+        "notes": suggestions["notes"],
+    })
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+class TimingMiddleware:
+    # Same per-request timing as test1.py's before/after_request hooks
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        handle = metrics.start_request()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = "unmatched" if status == 404 else scope["path"]
+            metrics.finish_request(handle, route, status)
+            core.mark_first_request()
+
+app = Starlette(routes=[
+    Route('/api/disease-detection', disease_detection_api, methods=['POST']),
+    Route('/api/crop-recommendation', crop_recommendation_api, methods=['POST']),
+    Route('/metrics', metrics_endpoint),
+], middleware=[Middleware(TimingMiddleware)])
+core.mark("app_ready")
+
+# Main Entry Point
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host=os.getenv("HOST", "127.0.0.1"), port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,505 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+import metrics
+from concurrency import SingleFlight, is_rate_limited
+from ratelimit import RateGovernor
+from resilience import ResilientBackend
+from prompts import count_tokens, output_budget
+from structured import SCHEMAS, example_payload
+
+# Model backends. Every backend exposes generate_content(contents, stream=False)
+# with the same shape as genai.GenerativeModel: the result has .text and, when
+# streamed, iterates over chunks that each have .text. The optional endpoint
+# names the caller (see prompts.py) for its output budget and token metrics.
+MODEL_NAME = os.getenv("MODEL_NAME", "gemini-1.5-flash")
+
+generation_config = {
+    "temperature": 0.4,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 4096,
+}
+
+safety_settings = [
+    {"category": f"HARM_CATEGORY_{category}", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
+    for category in ["HARASSMENT", "HATE_SPEECH", "SEXUALLY_EXPLICIT", "DANGEROUS_CONTENT"]
+]
+
+def call_config(endpoint):
+    # Per-call override, merged over the model's generation_config
+    budget = output_budget(endpoint)
+    return None if budget is None else {"max_output_tokens": budget}
+
+class GeminiBackend:
+    def __init__(self, model_name=MODEL_NAME):
+        import google.generativeai as genai
+
+        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        self.model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=generation_config,
+            safety_settings=safety_settings,
+        )
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        return self.model.generate_content(contents, stream=stream, generation_config=call_config(endpoint))
+
+    async def generate_content_async(self, contents, endpoint=None):
+        return await self.model.generate_content_async(contents, generation_config=call_config(endpoint))
+
+# Offline stand-in for capacity tests and CI
+class FakeUpstreamError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeResponse:
+    def __init__(self, chunks, first_token_delay, seconds_per_token, stream):
+        self._chunks = chunks
+        self._first_token_delay = first_token_delay
+        self._seconds_per_token = seconds_per_token
+        if not stream:
+            time.sleep(first_token_delay + seconds_per_token * len(chunks))
+            self._first_token_delay = self._seconds_per_token = 0
+        self.text = "".join(chunks)
+
+    def __iter__(self):
+        time.sleep(self._first_token_delay)
+        for chunk in self._chunks:
+            time.sleep(self._seconds_per_token)
+            yield FakeChunk(chunk)
+
+FAKE_VOCABULARY = (
+    "leaf spot blight rust mildew wilt fungal bacterial viral infection lesions yellowing "
+    "neem oil copper fungicide spray remove infected leaves improve drainage crop rotation "
+    "monsoon humidity soil moisture nitrogen potassium resistant variety early morning "
+    "irrigation spacing sunlight mulch compost paddy coconut banana pepper tomato chilli"
+).split()
+
+class FakeBackend:
+    # Latency is log-normal around FAKE_LATENCY_MS (time to first token), then
+    # tokens arrive at FAKE_TOKENS_PER_SEC. Response text is derived from a hash
+    # of the request, so identical requests always get identical answers.
+    def __init__(self):
+        self.latency = float(os.getenv("FAKE_LATENCY_MS", "800")) / 1000
+        self.latency_sigma = float(os.getenv("FAKE_LATENCY_SIGMA", "0.3"))
+        self.tokens_per_second = float(os.getenv("FAKE_TOKENS_PER_SEC", "200"))
+        self.response_tokens = int(os.getenv("FAKE_RESPONSE_TOKENS", "250"))
+        self.error_rate = float(os.getenv("FAKE_ERROR_RATE", "0"))
+        self.rate_limit_rate = float(os.getenv("FAKE_429_RATE", "0"))
+        self._random = random.Random(int(os.getenv("FAKE_SEED", "0")))
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        first_token_delay, error = self._roll()
+        if error is not None:
+            time.sleep(first_token_delay)
+            raise error
+
+        chunks = self._response_chunks(contents, endpoint)
+        return FakeResponse(chunks, first_token_delay, 1 / self.tokens_per_second, stream)
+
+    async def generate_content_async(self, contents, endpoint=None):
+        first_token_delay, error = self._roll()
+        if error is not None:
+            await asyncio.sleep(first_token_delay)
+            raise error
+
+        chunks = self._response_chunks(contents, endpoint)
+        await asyncio.sleep(first_token_delay + len(chunks) / self.tokens_per_second)
+        return FakeResponse(chunks, 0, 0, stream=False)
+
+    def _roll(self):
+        # Returns (delay before the first token or the error, error to raise)
+        with self._lock:
+            roll = self._random.random()
+            first_token_delay = self.latency * math.exp(self._random.gauss(0, self.latency_sigma))
+
+        if roll < self.rate_limit_rate:
+            return first_token_delay / 10, FakeUpstreamError("429 Resource has been exhausted (fake backend)", 429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            return first_token_delay, FakeUpstreamError("500 Internal error (fake backend)", 500)
+        return first_token_delay, None
+
+    def _response_chunks(self, contents, endpoint=None):
+        if not isinstance(contents, (list, tuple)):
+            contents = [contents]
+        digest = hashlib.sha256()
+        prompt = ""
+        for part in contents:
+            if isinstance(part, dict):
+                digest.update(part["data"])
+            else:
+                prompt += str(part)
+                digest.update(str(part).encode("utf-8"))
+        # Free text stops at the endpoint's output budget, like the real model
+        budget = output_budget(endpoint) or self.response_tokens
+        words = random.Random(digest.digest()).choices(FAKE_VOCABULARY, k=min(self.response_tokens, budget))
+        # Structured prompts get schema-shaped JSON, still streamed word by word
+        for kind, schema in SCHEMAS.items():
+            if schema in prompt:
+                padded = words + FAKE_VOCABULARY
+                return re.findall(r"\S+\s*", json.dumps(example_payload(kind, padded)))
+        return [word + " " for word in words]
+
+# Upstream quota governor (see ratelimit.py); RATE_LIMIT=0 disables it
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") != "0"
+# Tokens budgeted per call for the answer, corrected from usage metadata
+# after; never more than the endpoint's output budget
+OUTPUT_TOKENS_ESTIMATE = int(os.getenv("OUTPUT_TOKENS_ESTIMATE", "500"))
+# Gemini bills each image as a fixed number of tokens
+IMAGE_TOKENS = 258
+
+def estimate_input_tokens(contents):
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    return sum(IMAGE_TOKENS if isinstance(part, dict) else count_tokens(str(part)) for part in contents)
+
+def estimate_tokens(contents, endpoint=None):
+    budget = output_budget(endpoint)
+    output_tokens = OUTPUT_TOKENS_ESTIMATE if budget is None else min(OUTPUT_TOKENS_ESTIMATE, budget)
+    return estimate_input_tokens(contents) + output_tokens
+
+def used_tokens(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) or None
+
+class GovernedStream:
+    # Holds the governor slot until the stream is drained or abandoned, so
+    # streamed calls count against the concurrency limit for as long as they
+    # actually run, and sample their full latency
+    def __init__(self, response, on_done):
+        self._response = response
+        self._on_done = on_done
+
+    def __iter__(self):
+        completed = False
+        try:
+            for chunk in self._response:
+                yield chunk
+            completed = True
+        except Exception as e:
+            self._finish(error=e)
+            raise
+        finally:
+            self._finish(completed=completed)
+
+    def _finish(self, completed=False, error=None):
+        on_done, self._on_done = self._on_done, None
+        if on_done is not None:
+            on_done(self._response, completed, error)
+
+    def __del__(self):
+        # Never iterated: give the slot back without a latency sample
+        self._finish()
+
+    @property
+    def text(self):
+        return "".join(chunk.text for chunk in self)
+
+class GovernedBackend:
+    def __init__(self, backend, governor):
+        self.backend = backend
+        self.governor = governor
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        estimate = estimate_tokens(contents, endpoint)
+        self.governor.acquire(estimate)
+        started = time.monotonic()
+        try:
+            response = self.backend.generate_content(contents, stream=stream, endpoint=endpoint)
+        except BaseException as e:
+            self._release_failed(e)
+            raise
+        if stream:
+            return GovernedStream(
+                response, lambda response, completed, error: self._release_stream(
+                    response, started, estimate, completed, error
+                ),
+            )
+        self._release(response, started, estimate)
+        return response
+
+    async def generate_content_async(self, contents, endpoint=None):
+        estimate = estimate_tokens(contents, endpoint)
+        await self.governor.acquire_async(estimate)
+        started = time.monotonic()
+        try:
+            response = await self.backend.generate_content_async(contents, endpoint=endpoint)
+        except BaseException as e:
+            # Including CancelledError, e.g. a losing hedge or a client that hung up
+            self._release_failed(e)
+            raise
+        self._release(response, started, estimate)
+        return response
+
+    def _release(self, response, started, estimate):
+        used = used_tokens(response)
+        self.governor.release(
+            latency=time.monotonic() - started,
+            extra_tokens=used - estimate if used else 0,
+        )
+
+    def _release_failed(self, error):
+        self.governor.release(rate_limited=isinstance(error, Exception) and is_rate_limited(error))
+
+    def _release_stream(self, response, started, estimate, completed, error):
+        if error is not None:
+            self._release_failed(error)
+        elif completed:
+            # Streamed usage metadata is only complete once drained
+            self._release(response, started, estimate)
+        else:
+            # Abandoned part-way: its latency says nothing about the upstream
+            self.governor.release()
+
+    def has_capacity(self):
+        return self.governor.has_capacity()
+
+    def stats(self):
+        return self.governor.stats()
+
+# Upstream call, error and token counters (see metrics.py); innermost, so
+# every retry and hedge counts as the separate call it is
+class CountedStream:
+    def __init__(self, response, contents, endpoint):
+        self._response = response
+        self._contents = contents
+        self._endpoint = endpoint
+
+    def __iter__(self):
+        for chunk in self._response:
+            yield chunk
+        # Streamed usage metadata is only complete once the stream is drained
+        record_usage(self._response, self._contents, self._endpoint)
+
+    @property
+    def text(self):
+        return self._response.text
+
+    @property
+    def usage_metadata(self):
+        return getattr(self._response, "usage_metadata", None)
+
+def record_usage(response, contents, endpoint=None):
+    usage = getattr(response, "usage_metadata", None)
+    tokens_in = getattr(usage, "prompt_token_count", None) or estimate_input_tokens(contents)
+    tokens_out = getattr(usage, "candidates_token_count", None)
+    if tokens_out is None:
+        tokens_out = count_tokens(response.text)
+    metrics.TOKENS.inc("in", amount=tokens_in)
+    metrics.TOKENS.inc("out", amount=tokens_out)
+    metrics.record_tokens(endpoint or "other", tokens_in, tokens_out, output_budget(endpoint))
+
+class InstrumentedBackend:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        mode = "stream" if stream else "sync"
+        try:
+            response = self.backend.generate_content(contents, stream=stream, endpoint=endpoint)
+        except Exception as e:
+            self._record_error(mode, e)
+            raise
+        metrics.UPSTREAM_CALLS.inc(mode, "ok")
+        if stream:
+            return CountedStream(response, contents, endpoint)
+        record_usage(response, contents, endpoint)
+        return response
+
+    async def generate_content_async(self, contents, endpoint=None):
+        try:
+            response = await self.backend.generate_content_async(contents, endpoint=endpoint)
+        except Exception as e:
+            self._record_error("async", e)
+            raise
+        metrics.UPSTREAM_CALLS.inc("async", "ok")
+        record_usage(response, contents, endpoint)
+        return response
+
+    def _record_error(self, mode, error):
+        metrics.UPSTREAM_CALLS.inc(mode, "error")
+        metrics.UPSTREAM_ERRORS.inc(type(error).__name__)
+
+# Retries, hedging and circuit breaking (see resilience.py); RESILIENCE=0 disables them
+RESILIENCE = os.getenv("RESILIENCE", "1") != "0"
+
+# In-flight deduplication: identical prompts sent while one is already in
+# flight wait for that call and share its response
+MODEL_COALESCE = os.getenv("MODEL_COALESCE", "1") != "0"
+
+def prompt_key(contents):
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    digest = hashlib.sha256()
+    for part in contents:
+        digest.update(b"\x1f")
+        if isinstance(part, dict):
+            digest.update(part["mime_type"].encode("utf-8"))
+            digest.update(part["data"])
+        else:
+            digest.update(" ".join(str(part).split()).encode("utf-8"))
+    return digest.hexdigest()
+
+class SharedStream:
+    # Replays one upstream stream to any number of consumers, each from the
+    # start. Published before the upstream call is opened, so concurrent
+    # callers join it instead of opening their own; they wait in iteration
+    # until the opener attaches the response (or the error opening it).
+    def __init__(self, on_done):
+        self._iterator = None
+        self._on_done = on_done
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._opened = threading.Event()
+        self._lock = threading.Lock()
+
+    def attach(self, response):
+        self._iterator = iter(response)
+        self._opened.set()
+
+    def fail(self, error):
+        with self._lock:
+            self._error = error
+            self._finish()
+        self._opened.set()
+
+    def __iter__(self):
+        self._opened.wait()
+        index = 0
+        while True:
+            with self._lock:
+                if index == len(self._chunks) and not self._done:
+                    try:
+                        self._chunks.append(next(self._iterator))
+                    except StopIteration:
+                        self._finish()
+                    except Exception as e:
+                        self._error = e
+                        self._finish()
+                if index < len(self._chunks):
+                    chunk = self._chunks[index]
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+            index += 1
+            yield chunk
+
+    def _finish(self):
+        self._done = True
+        self._on_done()
+
+    @property
+    def text(self):
+        return "".join(chunk.text for chunk in self)
+
+class CoalescingBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.flight = SingleFlight()
+        self._streams = {}
+        self._streams_lock = threading.Lock()
+        self.stream_calls = 0
+        self.streams_coalesced = 0
+        self._async_calls = {}
+        self.async_calls = 0
+        self.async_coalesced = 0
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        # The same prompt under another budget is a different call
+        key = (prompt_key(contents), endpoint)
+        if not stream:
+            return self.flight.do(key, lambda: self.backend.generate_content(contents, endpoint=endpoint))
+
+        with self._streams_lock:
+            shared = self._streams.get(key)
+            if shared is not None:
+                self.streams_coalesced += 1
+                return shared
+            self.stream_calls += 1
+            shared = self._streams[key] = SharedStream(lambda: self._release(key))
+        # Open the upstream stream outside the lock; callers that found the
+        # placeholder meanwhile wait for it in iteration
+        try:
+            response = self.backend.generate_content(contents, stream=True, endpoint=endpoint)
+        except BaseException as e:
+            shared.fail(e)
+            raise
+        shared.attach(response)
+        return shared
+
+    async def generate_content_async(self, contents, endpoint=None):
+        # Only ever touched from the event loop, so no lock is needed
+        key = (prompt_key(contents), endpoint)
+        future = self._async_calls.get(key)
+        if future is not None:
+            self.async_coalesced += 1
+        else:
+            self.async_calls += 1
+            future = asyncio.ensure_future(self.backend.generate_content_async(contents, endpoint=endpoint))
+            self._async_calls[key] = future
+            future.add_done_callback(lambda _: self._async_calls.pop(key, None))
+        # Shield so one cancelled waiter doesn't cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _release(self, key):
+        with self._streams_lock:
+            self._streams.pop(key, None)
+
+    def stats(self):
+        stats = self.flight.stats()
+        return {
+            "calls": stats["calls"] + self.stream_calls + self.async_calls,
+            "coalesced": stats["coalesced"] + self.streams_coalesced + self.async_coalesced,
+        }
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeBackend,
+}
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+def _reset_backend_lock():
+    # A fork can happen while another thread holds the lock
+    global _backend_lock
+    _backend_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_backend_lock)
+
+def get_backend():
+    # MODEL_BACKEND selects the implementation; one instance per process,
+    # built on first use. A forked worker (gunicorn --preload, multiprocessing)
+    # builds its own rather than sharing the parent's client and its sockets.
+    global _backend, _backend_pid
+    with _backend_lock:
+        if _backend is None or _backend_pid != os.getpid():
+            _backend_pid = os.getpid()
+            _backend = BACKENDS[os.getenv("MODEL_BACKEND", "gemini")]()
+            if metrics.METRICS_ENABLED:
+                _backend = InstrumentedBackend(_backend)
+            if RATE_LIMIT:
+                _backend = GovernedBackend(_backend, RateGovernor())
+            if RESILIENCE:
+                _backend = ResilientBackend(_backend)
+            if MODEL_COALESCE:
+                _backend = CoalescingBackend(_backend)
+        return _backend
@@ -0,0 +1,220 @@
+"""Load test for the Flask API in test1.py.
+
+Replays the bundled images/ photos and synthetic soil profiles against
+/api/disease-detection and /api/crop-recommendation at a fixed concurrency,
+then reports latency percentiles, throughput, memory high-water mark and
+cache hit rates as JSON. By default the app is served in-process on the
+offline fake model backend; pass --url to target a running server instead
+(the report then has only the client's memory, as client_max_rss_mb).
+
+    python benchmarks/load_test.py --requests 500 --concurrency 32
+    python benchmarks/load_test.py --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+REGIONS = [
+    ("Kerala", "Thrissur", "Chalakudy"),
+    ("Kerala", "Palakkad", "Chittur"),
+    ("Tamil Nadu", "Coimbatore", "Pollachi"),
+    ("Karnataka", "Mandya", "Maddur"),
+    ("Andhra Pradesh", "Guntur", "Tenali"),
+]
+SOIL_TYPES = ["Clay", "Sandy", "Loamy", "Laterite", "Black cotton"]
+NUTRIENTS = ["High N, Low P", "Low N", "Balanced NPK", "Low K"]
+TEXTURES = ["60% sand, 30% silt", "40% clay", "Fine loam"]
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def multipart_body(fields, file_field, filename, data):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode()
+        + data + b"\r\n"
+    )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def build_workload(count, crop_ratio, seed):
+    rng = random.Random(seed)
+    images = [(path.name, path.read_bytes()) for path in sorted((ROOT / "images").iterdir())
+              if path.suffix.lower() in IMAGE_SUFFIXES]
+    workload = []
+    for _ in range(count):
+        state, district, area = rng.choice(REGIONS)
+        if rng.random() < crop_ratio:
+            profile = {
+                "soil_type": rng.choice(SOIL_TYPES),
+                "ph_level": f"{rng.uniform(5.0, 8.0):.1f}",
+                "nutrients": rng.choice(NUTRIENTS),
+                "texture": rng.choice(TEXTURES),
+                "location": f"{district}, {state}",
+            }
+            body = json.dumps(profile).encode()
+            workload.append(("crop-recommendation", body, "application/json"))
+        else:
+            filename, data = rng.choice(images)
+            fields = {"language": "English", "district": district, "state": state, "area": area}
+            body, content_type = multipart_body(fields, "image", filename, data)
+            workload.append(("disease-detection", body, content_type))
+    return workload
+
+def start_local_server():
+    from werkzeug.serving import make_server
+    import generation
+    import test1
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, test1.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # The caches and model live in generation.py, shared by every entry point
+    return server, f"http://127.0.0.1:{server.server_port}", generation
+
+def run(url, workload, concurrency, timeout):
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def send(item):
+        endpoint, body, content_type = item
+        request = urllib.request.Request(
+            f"{url}/api/{endpoint}", data=body, headers={"Content-Type": content_type}
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+            failed = False
+        except Exception:
+            failed = True
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.setdefault(endpoint, []).append(elapsed)
+            if failed:
+                errors[endpoint] = errors.get(endpoint, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, workload))
+    return latencies, errors, time.perf_counter() - started
+
+def summarize(latencies, errors, duration, app_module):
+    report = {"requests": sum(map(len, latencies.values())), "duration_s": round(duration, 3)}
+    report["requests_per_s"] = round(report["requests"] / duration, 2)
+    report["endpoints"] = {}
+    for endpoint, values in sorted(latencies.items()):
+        report["endpoints"][endpoint] = {
+            "count": len(values),
+            "errors": errors.get(endpoint, 0),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+        }
+    # ru_maxrss is reported in kilobytes on Linux. It is this process's peak:
+    # the server's only when it runs in-process, otherwise just the client's
+    max_rss_mb = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    report["max_rss_mb" if app_module is not None else "client_max_rss_mb"] = max_rss_mb
+    if app_module is not None:
+        report["caches"] = {}
+        for name in ("diagnosis_cache", "text_cache", "near_duplicates"):
+            stats = getattr(app_module, name).stats()
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+            report["caches"][name] = stats
+        # Walk the backend wrappers (coalescing, resilience, rate governor)
+        backend = app_module.model
+        while backend is not None:
+            if hasattr(backend, "stats"):
+                report[type(backend).__name__] = backend.stats()
+            backend = getattr(backend, "backend", None)
+    return report
+
+def regressions(report, baseline, tolerance):
+    found = []
+    if report["requests_per_s"] < baseline["requests_per_s"] * (1 - tolerance):
+        found.append(f"requests_per_s {report['requests_per_s']} < baseline {baseline['requests_per_s']}")
+    for endpoint, stats in baseline.get("endpoints", {}).items():
+        current = report["endpoints"].get(endpoint)
+        if current is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if current[key] > stats[key] * (1 + tolerance):
+                found.append(f"{endpoint} {key} {current[key]} > baseline {stats[key]}")
+        if current["errors"] > stats["errors"]:
+            found.append(f"{endpoint} errors {current['errors']} > baseline {stats['errors']}")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="target a running server instead of an in-process one")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--crop-ratio", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="fail if results regress against this report")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    app_module = None
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        # Offline by default: the fake backend with production-like latency
+        os.environ.setdefault("MODEL_BACKEND", "fake")
+        os.environ.setdefault("FAKE_LATENCY_MS", "300")
+        os.environ.setdefault("FAKE_TOKENS_PER_SEC", "1000")
+        server, url, app_module = start_local_server()
+
+    workload = build_workload(args.requests, args.crop_ratio, args.seed)
+    latencies, errors, duration = run(url, workload, args.concurrency, args.timeout)
+    report = summarize(latencies, errors, duration, app_module)
+    report["config"] = {"requests": args.requests, "concurrency": args.concurrency,
+                        "crop_ratio": args.crop_ratio, "seed": args.seed}
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+
+    if args.baseline:
+        baseline_path = Path(args.baseline)
+        if args.update_baseline:
+            baseline_path.write_text(output + "\n")
+            return 0
+        found = regressions(report, json.loads(baseline_path.read_text()), args.tolerance)
+        for line in found:
+            print(f"REGRESSION: {line}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""Micro-benchmarks for the per-request CPU work in the API.
+
+Times the pure-Python hot paths (reading uploads, cleaning and parsing model
+responses, building prompts, hashing cache keys) without any HTTP or model
+calls. Inputs are the bundled images/ photos and the recorded model responses
+in benchmarks/fixtures/responses.json, so runs are offline and repeatable.
+Every run is appended to a JSON-lines history file; --baseline fails when a
+case is slower than the baseline by more than --tolerance.
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py --baseline benchmarks/micro_baseline.json
+    python benchmarks/micro.py --record    # re-record the corpus from the live model
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures" / "responses.json"
+HISTORY = Path(__file__).resolve().parent / "micro_history.jsonl"
+
+PHOTO = ROOT / "images" / "PDD1.jpg"
+REGION = ("Kerala", "Thrissur", "Chalakudy")
+SOIL = ("Loamy", "6.5", "Low N", "Fine loam", "Thrissur, Kerala")
+
+def load_corpus(path=FIXTURES):
+    return json.loads(path.read_text(encoding="utf-8"))
+
+def split_chunks(text, size):
+    # Roughly what a streamed response delivers per chunk
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def build_cases(corpus):
+    import backends
+    import generation
+    from cache import decode_value, encode_value, image_cache_key
+    from images import read_image_data
+    from prompts import count_tokens
+    from regional_store import key_hash, make_key
+    from responses import clean_response_chunks, clean_response_text
+    from structured import dumps_compact, parse_crops, parse_diagnosis, render_diagnosis
+    from translation import translation_prompt
+
+    state, district, area = REGION
+    photo = PHOTO.read_bytes()
+    photo_stream = io.BytesIO(photo)
+    image_data = read_image_data(photo)
+    regional = corpus["regional_insights"]
+    # Multi-KB answers, as long free-text responses get
+    long_response = regional * 16
+    long_hindi = corpus["regional_insights_hindi"] * 16
+    chunks = split_chunks(long_response, 24)
+    diagnosis = parse_diagnosis(corpus["diagnosis"])
+    diagnosis_hindi = parse_diagnosis(corpus["diagnosis_hindi"])
+    diagnosis_json = dumps_compact(diagnosis)
+    prompt = generation.disease_analysis_prompt("English", district, state, area)
+    encoded = encode_value(regional)
+    generation.get_crop_suggestions.store(parse_crops(corpus["crop_suggestions"]), *SOIL)
+
+    return {
+        "read_image_data/bytes": lambda: read_image_data(photo),
+        "read_image_data/path": lambda: read_image_data(PHOTO),
+        "read_image_data/stream": lambda: read_image_data(photo_stream),
+        "clean_response_text/3kb": lambda: clean_response_text(regional),
+        "clean_response_text/45kb": lambda: clean_response_text(long_response),
+        "clean_response_text/hindi_32kb": lambda: clean_response_text(long_hindi),
+        "clean_response_chunks/45kb": lambda: list(clean_response_chunks(chunks)),
+        "parse_diagnosis/fenced": lambda: parse_diagnosis(corpus["diagnosis"]),
+        "parse_diagnosis/hindi": lambda: parse_diagnosis(corpus["diagnosis_hindi"]),
+        "parse_crops": lambda: parse_crops(corpus["crop_suggestions"]),
+        "render_diagnosis/hindi": lambda: render_diagnosis(diagnosis_hindi, "Hindi"),
+        "prompt/disease_analysis": lambda: generation.disease_analysis_prompt("English", district, state, area),
+        "prompt/regional_insights": lambda: generation.regional_insights_prompt(district, state, area),
+        "prompt/crop_suggestions": lambda: generation.crop_suggestions_prompt(*SOIL),
+        "prompt/translation": lambda: translation_prompt(diagnosis_json, "Hindi"),
+        "count_tokens/3kb": lambda: count_tokens(regional),
+        "key/image_cache_key": lambda: image_cache_key(
+            photo, "English", district, state, area, generation.DISEASE_PROMPT_VERSION
+        ),
+        "key/prompt_key": lambda: backends.prompt_key([prompt, image_data]),
+        "key/regional_store": lambda: key_hash(make_key(state, district, area, "kharif", "English")),
+        "key/memoize_hit": lambda: generation.get_crop_suggestions.lookup(*SOIL),
+        "cache/encode_value_3kb": lambda: encode_value(regional),
+        "cache/decode_value_3kb": lambda: decode_value(encoded),
+    }
+
+def measure(fn, repeat):
+    # Loops are calibrated to ~0.2 s per repeat; the best repeat is the
+    # least disturbed by the rest of the machine
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = [elapsed / number for elapsed in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "best_us": round(min(times) * 1e6, 3),
+        "median_us": round(statistics.median(times) * 1e6, 3),
+        "loops": number,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def regressions(report, baseline, tolerance):
+    found = []
+    for case, stats in baseline.get("results", {}).items():
+        current = report["results"].get(case)
+        if current is not None and current["best_us"] > stats["best_us"] * (1 + tolerance):
+            found.append(f"{case} {current['best_us']} us > baseline {stats['best_us']} us")
+    return found
+
+def record(path):
+    # Replaces the corpus with live answers to the same prompts (needs the
+    # configured model backend, e.g. GOOGLE_API_KEY for Gemini)
+    import generation
+    from images import preprocess_image_data, read_image_data
+    from structured import dumps_compact, parse_diagnosis
+    from translation import translation_prompt
+
+    state, district, area = REGION
+    image = preprocess_image_data(read_image_data(PHOTO))
+    diagnosis = generation.model.generate_content(
+        [generation.disease_analysis_prompt("English", district, state, area), image], endpoint="disease_analysis"
+    ).text
+    corpus = {
+        "regional_insights": generation.model.generate_content(
+            [generation.regional_insights_prompt(district, state, area)], endpoint="regional_insights"
+        ).text,
+        "regional_insights_hindi": generation.model.generate_content(
+            [f"Provide the following response in Hindi: {generation.regional_insights_prompt(district, state, area)}"],
+            endpoint="regional_insights",
+        ).text,
+        "diagnosis": diagnosis,
+        "diagnosis_hindi": generation.model.generate_content(
+            [translation_prompt(dumps_compact(parse_diagnosis(diagnosis)), "Hindi")], endpoint="translation"
+        ).text,
+        "crop_suggestions": generation.model.generate_content(
+            [generation.crop_suggestions_prompt(*SOIL)], endpoint="crop_suggestions"
+        ).text,
+    }
+    path.write_text(json.dumps(corpus, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--history", default=str(HISTORY), help="append results here ('' to skip)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="fail if any case regresses against this report")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--record", action="store_true", help="re-record the response corpus and exit")
+    args = parser.parse_args()
+
+    if args.record:
+        record(FIXTURES)
+        return 0
+
+    # Nothing here calls the model, but importing the app builds its caches;
+    # keep them in memory and off the network
+    os.environ.setdefault("MODEL_BACKEND", "fake")
+    for name in ("CACHE_DIR", "DIAGNOSIS_CACHE_PATH", "TEXT_CACHE_PATH", "TRANSLATION_CACHE_PATH"):
+        os.environ.pop(name, None)
+
+    cases = build_cases(load_corpus())
+    results = {
+        name: measure(fn, args.repeat)
+        for name, fn in cases.items() if not args.filter or args.filter in name
+    }
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    if args.history:
+        with open(args.history, "a", encoding="utf-8") as history:
+            history.write(json.dumps(report) + "\n")
+
+    if args.baseline:
+        baseline_path = Path(args.baseline)
+        if args.update_baseline:
+            baseline_path.write_text(output + "\n")
+            return 0
+        found = regressions(report, json.loads(baseline_path.read_text()), args.tolerance)
+        for line in found:
+            print(f"REGRESSION: {line}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
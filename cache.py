@@ -0,0 +1,441 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import metrics
+from concurrency import AsyncSingleFlight, SingleFlight, executor
+from structured import dumps_compact
+
+# Response caches for model output. Values are the final response strings, so
+# a hit skips the model call entirely.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_FRESH_TTL = float(os.getenv("TEXT_CACHE_FRESH_TTL", 24 * 3600))
+
+def image_cache_key(image_bytes, *fields):
+    # Content-addressed key: hash of the image bytes plus every field that
+    # changes the answer (language, region, prompt version, ...)
+    digest = hashlib.sha256(image_bytes)
+    for field in fields:
+        digest.update(b"\x1f")
+        digest.update(str(field).encode("utf-8"))
+    return digest.hexdigest()
+
+# Values at least this long are stored zlib-compressed; diagnosis and
+# insight texts shrink to roughly a third
+CACHE_COMPRESS_MIN_BYTES = int(os.getenv("CACHE_COMPRESS_MIN_BYTES", 512))
+# Shared directory for every cache; one SQLite file per cache, usable by all
+# worker processes (overridden per cache by {PREFIX}_PATH)
+CACHE_DIR = os.getenv("CACHE_DIR")
+# How long a cross-process get_or_compute waits for another process's
+# computation before doing it itself
+CACHE_LEASE_TTL = float(os.getenv("CACHE_LEASE_TTL", 90))
+LEASE_POLL_INTERVAL = 0.05
+# Hits only note their access time in memory; the times are written in one
+# batch at most this often (and before every eviction), so a hit is a plain
+# read rather than a cross-process write transaction
+CACHE_TOUCH_INTERVAL = float(os.getenv("CACHE_TOUCH_INTERVAL", 30))
+
+def encode_value(value):
+    data = value.encode("utf-8")
+    if len(data) >= CACHE_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data, 6)
+        if len(compressed) < len(data):
+            return b"z" + compressed
+    return b"t" + data
+
+def decode_value(data):
+    if isinstance(data, str):
+        # Rows written before values were encoded
+        return data
+    if data[:1] == b"z":
+        return zlib.decompress(data[1:]).decode("utf-8")
+    return data[1:].decode("utf-8")
+
+class LRUCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, name="cache"):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._lookup(key, count=True)
+
+    def _peek(self, key):
+        # Lookup that isn't counted as a hit or miss, for get_or_compute:
+        # its callers have already counted theirs
+        return self._lookup(key, count=False)
+
+    def _lookup(self, key, count):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                    metrics.CACHE_REQUESTS.inc(self.name, "miss")
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+                metrics.CACHE_REQUESTS.inc(self.name, "hit")
+            data = entry[1]
+        return decode_value(data)
+
+    def set(self, key, value):
+        data = encode_value(value)
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, data, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def get_or_compute(self, key, compute):
+        # compute() returns the value to store; concurrent callers share one call
+        value = self._peek(key)
+        if value is not None:
+            return value
+
+        def compute_and_set():
+            value = compute()
+            self.set(key, value)
+            return value
+
+        return self._flight.do(key, compute_and_set)
+
+    async def get_or_compute_async(self, key, compute):
+        # As get_or_compute, on an event loop: compute is a coroutine function
+        value = self._peek(key)
+        if value is not None:
+            return value
+
+        async def compute_and_set():
+            value = await compute()
+            self.set(key, value)
+            return value
+
+        return await self._async_flight.do(key, compute_and_set)
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.size}
+
+class SQLiteCache:
+    # Same interface as LRUCache, persisted to disk so hits survive restarts.
+    # In WAL mode every worker process can share one file; the byte total and
+    # computation leases live in the database, so they are shared too.
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL, name="cache"):
+        self.path = path
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._flight = SingleFlight()
+        self._async_flight = AsyncSingleFlight()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        # key -> last hit, not yet written to accessed_at
+        self._touched = {}
+        self._touched_flushed = time.monotonic()
+        with self._lock:
+            self._connection()
+
+    def _connection(self):
+        # A connection must not cross a fork, so each process opens its own
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._pid = os.getpid()
+            self._touched = {}
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta (name, value) SELECT 'size', COALESCE(SUM(size), 0) FROM entries"
+            )
+        return self._conn
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size(self._connection())
+
+    def _size(self, conn):
+        return conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def get(self, key):
+        return self._lookup(key, count=True)
+
+    def _peek(self, key):
+        # Uncounted, as LRUCache._peek
+        return self._lookup(key, count=False)
+
+    def _lookup(self, key, count):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] < now:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    self._delete(conn, key)
+                row = None
+            if row is None:
+                if count:
+                    self.misses += 1
+                    metrics.CACHE_REQUESTS.inc(self.name, "miss")
+                return None
+            self._touched[key] = now
+            if time.monotonic() - self._touched_flushed >= CACHE_TOUCH_INTERVAL:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    self._flush_touched(conn)
+            if count:
+                self.hits += 1
+                metrics.CACHE_REQUESTS.inc(self.name, "hit")
+        return decode_value(row[0])
+
+    def _flush_touched(self, conn):
+        # Inside a write transaction; a key deleted meanwhile matches no row
+        if self._touched:
+            conn.executemany(
+                "UPDATE entries SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                [(accessed, key) for key, accessed in self._touched.items()],
+            )
+            self._touched.clear()
+        self._touched_flushed = time.monotonic()
+
+    def set(self, key, value):
+        data = encode_value(value)
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # One write transaction, so concurrent processes keep the byte total exact
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._delete(conn, key)
+                conn.execute(
+                    "INSERT INTO entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, data, size, now + self.ttl, now),
+                )
+                conn.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (size,))
+                expired = conn.execute(
+                    "SELECT key FROM entries WHERE expires_at < ? LIMIT 100", (now,)
+                ).fetchall()
+                for (expired_key,) in expired:
+                    self._delete(conn, expired_key)
+                if self._size(conn) > self.max_bytes:
+                    # Evict by up-to-date access times
+                    self._flush_touched(conn)
+                while self._size(conn) > self.max_bytes:
+                    oldest = conn.execute(
+                        "SELECT key FROM entries ORDER BY accessed_at LIMIT 1"
+                    ).fetchone()
+                    self._delete(conn, oldest[0])
+
+    def _delete(self, conn, key):
+        row = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            conn.execute("UPDATE meta SET value = value - ? WHERE name = 'size'", (row[0],))
+
+    def get_or_compute(self, key, compute):
+        # Atomic across processes: one caller per key holds a lease and
+        # computes; the others wait for its value. A lease older than
+        # CACHE_LEASE_TTL (e.g. its process died) can be taken over.
+        return self._flight.do(key, lambda: self._get_or_compute(key, compute))
+
+    def _get_or_compute(self, key, compute):
+        deadline = time.monotonic() + CACHE_LEASE_TTL
+        while True:
+            value = self._peek(key)
+            if value is not None:
+                return value
+            if self._acquire_lease(key) or time.monotonic() >= deadline:
+                break
+            time.sleep(LEASE_POLL_INTERVAL)
+
+        try:
+            value = compute()
+            self.set(key, value)
+            return value
+        finally:
+            self._release_lease(key)
+
+    async def get_or_compute_async(self, key, compute):
+        # As get_or_compute, on an event loop: compute is a coroutine function,
+        # and the database work and lease waits don't block the loop
+        return await self._async_flight.do(key, lambda: self._get_or_compute_async(key, compute))
+
+    async def _get_or_compute_async(self, key, compute):
+        deadline = time.monotonic() + CACHE_LEASE_TTL
+        while True:
+            value = await asyncio.to_thread(self._peek, key)
+            if value is not None:
+                return value
+            if await asyncio.to_thread(self._acquire_lease, key) or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+
+        try:
+            value = await compute()
+            await asyncio.to_thread(self.set, key, value)
+            return value
+        finally:
+            await asyncio.to_thread(self._release_lease, key)
+
+    def _acquire_lease(self, key):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("DELETE FROM leases WHERE key = ? AND expires_at < ?", (key, now))
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                    (key, os.getpid(), now + CACHE_LEASE_TTL),
+                )
+                return cursor.rowcount == 1
+
+    def _release_lease(self, key):
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM leases WHERE key = ? AND owner = ?", (key, os.getpid())
+            )
+
+    def stats(self):
+        with self._lock:
+            conn = self._connection()
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            size = self._size(conn)
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+def cache_from_env(prefix):
+    # e.g. DIAGNOSIS_CACHE_PATH, DIAGNOSIS_CACHE_MAX_BYTES, DIAGNOSIS_CACHE_TTL
+    max_bytes = int(os.getenv(f"{prefix}_MAX_BYTES", DEFAULT_MAX_BYTES))
+    ttl = float(os.getenv(f"{prefix}_TTL", DEFAULT_TTL))
+    name = prefix.lower()
+    path = os.getenv(f"{prefix}_PATH")
+    if not path and CACHE_DIR:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+    if path:
+        return SQLiteCache(path, max_bytes=max_bytes, ttl=ttl, name=name)
+    return LRUCache(max_bytes=max_bytes, ttl=ttl, name=name)
+
+# Key canonicalization for text-only prompts, so that "Kerala", " kerala "
+# and "Kerala, India" share one cache entry
+REGION_ALIASES = {
+    "ap": "andhra pradesh",
+    "hp": "himachal pradesh",
+    "j&k": "jammu and kashmir",
+    "mp": "madhya pradesh",
+    "tn": "tamil nadu",
+    "up": "uttar pradesh",
+    "wb": "west bengal",
+    "orissa": "odisha",
+    "pondicherry": "puducherry",
+}
+
+def normalize_text(value):
+    return " ".join(str(value or "").casefold().split()).strip(" .,;")
+
+def normalize_region(value):
+    region = normalize_text(value)
+    region = re.sub(r"[\s,]*\bindia$", "", region).strip(" .,;")
+    return REGION_ALIASES.get(region, region)
+
+def normalize_ph(value):
+    match = re.search(r"\d+(?:\.\d+)?", str(value or ""))
+    if not match:
+        return normalize_text(value)
+    return f"{round(float(match.group()), 1):.1f}"
+
+def memoize(cache, namespace, key_fn, fresh_ttl=DEFAULT_FRESH_TTL):
+    # Entries are fresh for fresh_ttl seconds. After that, until the cache's own
+    # ttl expires them, the stale value is returned immediately while one
+    # background call refreshes it (stale-while-revalidate).
+    flight = SingleFlight()
+
+    def decorator(fn):
+        def make_key(args):
+            key_fields = [namespace, *key_fn(*args)]
+            return hashlib.sha256("\x1f".join(key_fields).encode("utf-8")).hexdigest()
+
+        def store(value, *args):
+            cache.set(make_key(args), dumps_compact([time.time() + fresh_ttl, value]))
+
+        def lookup(*args):
+            # Cached value (fresh or stale) or None; a stale hit schedules a refresh
+            key = make_key(args)
+            entry = cache.get(key)
+            if entry is None:
+                return None
+            fresh_until, value = json.loads(entry)
+            if time.time() >= fresh_until and not flight.in_flight(key):
+                executor.submit(flight.do, key, lambda: compute(args))
+            return value
+
+        def compute(args):
+            value = fn(*args)
+            store(value, *args)
+            return value
+
+        @functools.wraps(fn)
+        def wrapper(*args):
+            value = lookup(*args)
+            if value is not None:
+                return value
+            # A shared cache makes this a single computation across processes
+            key = make_key(args)
+            entry = flight.do(key, lambda: cache.get_or_compute(
+                key, lambda: dumps_compact([time.time() + fresh_ttl, fn(*args)])
+            ))
+            return json.loads(entry)[1]
+
+        # Streaming callers check and fill the same cache entries
+        wrapper.lookup = lookup
+        wrapper.store = store
+        return wrapper
+
+    return decorator
@@ -0,0 +1,174 @@
+import asyncio
+import contextvars
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+
+from ratelimit import BATCH, request_priority
+
+# Shared pool for independent model calls made while serving one request
+MAX_WORKERS = int(os.getenv("MODEL_MAX_WORKERS", "8"))
+CALL_TIMEOUT = float(os.getenv("MODEL_CALL_TIMEOUT", "60"))
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="model-call")
+
+# Batch jobs get their own pool so they can't starve interactive requests
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "3"))
+BATCH_BACKOFF = float(os.getenv("BATCH_BACKOFF", "2"))
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="batch-call")
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of fn
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced}
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines: concurrent awaits with the same key share
+    # one task. Only touched from the event loop, so no lock is needed; the
+    # task is shielded so one cancelled caller doesn't cancel the others.
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+def run_concurrently(calls, timeout=CALL_TIMEOUT):
+    # calls maps a name to a zero-argument callable. Every call gets `timeout`
+    # seconds from submission; the exception of one that raises or times out is
+    # reported in `errors` without discarding the results of the others.
+    # Each call runs in a copy of the caller's context (priority, timings).
+    futures = {
+        name: executor.submit(contextvars.copy_context().run, fn) for name, fn in calls.items()
+    }
+    deadline = time.monotonic() + timeout
+    results, errors = {}, {}
+
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeout:
+            future.cancel()
+            errors[name] = TimeoutError(f"Timed out after {timeout:g} seconds")
+        except Exception as e:
+            errors[name] = e
+
+    return results, errors
+
+def merge_streams(streams, timeout=CALL_TIMEOUT):
+    # streams maps a name to an iterator of chunks. Each one is drained on the
+    # shared pool and (name, chunk, error) tuples are yielded in arrival order,
+    # so one slow stream never holds back another.
+    events = queue.Queue()
+    done = object()
+
+    def drain(name, stream):
+        try:
+            for chunk in stream:
+                events.put((name, chunk, None))
+        except Exception as e:
+            events.put((name, None, str(e)))
+        finally:
+            events.put((name, done, None))
+
+    for name, stream in streams.items():
+        executor.submit(contextvars.copy_context().run, drain, name, stream)
+
+    pending = set(streams)
+    deadline = time.monotonic() + timeout
+    while pending:
+        try:
+            name, chunk, error = events.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            for name in pending:
+                yield name, None, f"Timed out after {timeout:g} seconds"
+            return
+        if chunk is done:
+            pending.discard(name)
+        else:
+            yield name, chunk, error
+
+def is_rate_limited(error):
+    # google.api_core raises ResourceExhausted (HTTP 429) when quota runs out
+    return getattr(error, "code", None) == 429 or type(error).__name__ == "ResourceExhausted"
+
+def _call_after(delay, fn, item):
+    # Work on the batch pool queues behind interactive requests for quota
+    request_priority.set(BATCH)
+    if delay:
+        time.sleep(delay)
+    return fn(item)
+
+def map_as_completed(fn, items, max_in_flight=BATCH_MAX_WORKERS):
+    # Yields (index, result, error) for every item as its call finishes.
+    # A rate-limited call is retried with exponential backoff and shrinks the
+    # number of calls kept in flight, so a batch slows down instead of
+    # turning a quota limit into a wall of errors.
+    pending = deque((index, item, 0) for index, item in enumerate(items))
+    in_flight = {}
+    window = max_in_flight
+
+    while pending or in_flight:
+        while pending and len(in_flight) < window:
+            index, item, attempt = pending.popleft()
+            delay = BATCH_BACKOFF * (2 ** (attempt - 1)) if attempt else 0
+            in_flight[batch_executor.submit(_call_after, delay, fn, item)] = (index, item, attempt)
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, item, attempt = in_flight.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                if is_rate_limited(e) and attempt < BATCH_MAX_RETRIES:
+                    window = max(1, window - 1)
+                    pending.append((index, item, attempt + 1))
+                else:
+                    yield index, None, str(e)
+                continue
+            yield index, result, None
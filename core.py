@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Shared start-up for every entry point. Import this module first: it loads
+# .env before other modules read their settings, and it times start-up from
+# here to the first request served.
+_started = time.perf_counter()
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import metrics
+
+logger = logging.getLogger("plantpal.startup")
+
+_phases = {}
+_phases_lock = threading.Lock()
+
+def mark(phase):
+    # Records the first time a process reaches `phase`
+    with _phases_lock:
+        if phase in _phases:
+            return
+        _phases[phase] = elapsed = time.perf_counter() - _started
+    metrics.STARTUP_SECONDS.set(elapsed, phase)
+
+def startup_report():
+    with _phases_lock:
+        return {"pid": os.getpid(), **{f"{phase}_ms": round(seconds * 1000, 1) for phase, seconds in _phases.items()}}
+
+def mark_first_request():
+    if "first_request" not in _phases:
+        mark("first_request")
+        logger.info("Startup: %s", json.dumps(startup_report()))
+
+def get_model():
+    # The backend chain is built on first use, in the process that uses it
+    # (see backends.get_backend), so importing an app costs no client set-up
+    from backends import get_backend
+
+    if "model_client" not in _phases:
+        backend = get_backend()
+        mark("model_client")
+        return backend
+    return get_backend()
+
+class LazyBackend:
+    # Module-level `model` for the apps: same interface as a backend, but
+    # nothing is imported or constructed until the first call
+    def generate_content(self, contents, stream=False, endpoint=None):
+        return get_model().generate_content(contents, stream=stream, endpoint=endpoint)
+
+    async def generate_content_async(self, contents, endpoint=None):
+        return await get_model().generate_content_async(contents, endpoint=endpoint)
+
+    @property
+    def backend(self):
+        return get_model()
+
+model = LazyBackend()
@@ -0,0 +1,181 @@
+import json
+
+import core
+from metrics import span
+from images import preprocess_image_data, read_image_data
+from cache import (
+    cache_from_env, image_cache_key, memoize, normalize_ph, normalize_region, normalize_text
+)
+from near_duplicates import PHashIndex, image_phash
+from prescreen import healthy_diagnosis, screen_image
+from regional_store import REGIONAL_STORE_PATH, RegionalStore, current_season
+from prompts import (
+    COMMON_DISEASES, CROP_SUGGESTIONS, DISEASE_ANALYSIS, IMAGE_DIAGNOSIS, REGIONAL_INSIGHTS, SEASONAL_INSIGHTS
+)
+from translation import CANONICAL_LANGUAGE, analysis_language, is_canonical, translate_diagnosis
+from responses import clean_response_text
+from structured import (
+    CROPS_SCHEMA, DIAGNOSIS_SCHEMA, dumps_compact, json_instructions, parse_crops, parse_diagnosis,
+    render_crops, render_diagnosis
+)
+
+# Model calls shared by every entry point (test1.py, asgi_app.py and the
+# Gradio apps), so their prompts, cache namespaces and keys can't drift apart.
+
+# Model backend: Gemini by default, MODEL_BACKEND=fake for offline runs. The
+# client is created on the first call, in the worker that makes it.
+model = core.model
+
+# Diagnoses are cached by image content as compact JSON; bump the version
+# when the prompt or schema changes
+DISEASE_PROMPT_VERSION = "disease-analysis-v3"
+diagnosis_cache = cache_from_env("DIAGNOSIS_CACHE")
+# Perceptual hash -> diagnosis cache key of an earlier, near-identical upload
+near_duplicates = PHashIndex()
+
+# Text-only answers are memoized on canonicalized inputs
+text_cache = cache_from_env("TEXT_CACHE")
+
+# Regional insights precomputed per season by the batch job in
+# regional_store.py; test1.py's workers keep the store fresh
+regional_store = RegionalStore(REGIONAL_STORE_PATH) if REGIONAL_STORE_PATH else None
+
+def disease_analysis_template(district, state, area):
+    # The regional prompt only when the farmer gave a location
+    return DISEASE_ANALYSIS if district or state or area else IMAGE_DIAGNOSIS
+
+def disease_analysis_prompt(language, district="", state="", area=""):
+    return disease_analysis_template(district, state, area).render(
+        area=area, district=district, state=state,
+        json_instructions=json_instructions(DIAGNOSIS_SCHEMA, language),
+    )
+
+def analyse_image(image, language, district="", state="", area=""):
+    # Structured diagnosis (see structured.py), validated before it is cached
+    with span("read_image"):
+        image_data = read_image_data(image)
+    with span("cache_key"):
+        cache_key = image_cache_key(
+            image_data["data"], language, district, state, area, DISEASE_PROMPT_VERSION
+        )
+    cached = diagnosis_cache.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    # Optional local pre-screen: junk raises ImageRejected, obviously healthy
+    # leaves get a templated answer without an upstream call
+    with span("prescreen"):
+        screening = screen_image(image_data["data"])
+    if screening is not None and screening["verdict"] == "healthy":
+        return healthy_diagnosis(screening)
+
+    # The model gets the downscaled image either way; hashing that copy
+    # rather than the upload keeps the lookup to a cheap thumbnail decode
+    with span("preprocess"):
+        model_image = preprocess_image_data(image_data)
+
+    # Re-photographed or re-compressed uploads reuse a near-identical image's diagnosis
+    group = (language, district, state, area, DISEASE_PROMPT_VERSION)
+    with span("phash_lookup"):
+        image_hash = image_phash(model_image["data"], screening)
+        similar_key = near_duplicates.get(image_hash, group) if image_hash is not None else None
+    cached = diagnosis_cache.get(similar_key) if similar_key else None
+    if cached is not None:
+        return json.loads(cached)
+
+    def diagnose():
+        template = disease_analysis_template(district, state, area)
+        language_prompt = disease_analysis_prompt(language, district, state, area)
+        with span("vision_call"):
+            response = model.generate_content([language_prompt, model_image], endpoint=template.endpoint)
+        with span("parse"):
+            return dumps_compact(parse_diagnosis(response.text))
+
+    # With a shared cache, workers uploading the same image make one call
+    diagnosis = json.loads(diagnosis_cache.get_or_compute(cache_key, diagnose))
+    if image_hash is not None:
+        near_duplicates.add(image_hash, group, cache_key)
+    return diagnosis
+
+def get_disease_diagnosis(image, language, district="", state="", area=""):
+    # One vision call per image whatever the language (see translation.py)
+    diagnosis = analyse_image(image, analysis_language(language), district, state, area)
+    return translate_diagnosis(diagnosis, language)
+
+def generate_disease_analysis(image, language, district="", state="", area=""):
+    return render_diagnosis(get_disease_diagnosis(image, language, district, state, area), language)
+
+def regional_insights_prompt(district, state, area):
+    return REGIONAL_INSIGHTS.render(area=area, district=district, state=state)
+
+@memoize(
+    text_cache,
+    "regional-insights-v1",
+    lambda district, state, area: (
+        normalize_text(district), normalize_region(state), normalize_text(area)
+    ),
+)
+def generate_regional_disease_insights(district, state, area):
+    with span("regional_call"):
+        response = model.generate_content(
+            [regional_insights_prompt(district, state, area)], endpoint=REGIONAL_INSIGHTS.endpoint
+        )
+    return clean_response_text(response.text)
+
+def generate_seasonal_insights(state, district, area, season, language):
+    # Batch job generator for the precomputed store (see regional_store.py)
+    prompt = SEASONAL_INSIGHTS.render(
+        area=area, district=district, state=state, season=season,
+        language_instruction="" if is_canonical(language) else f"Provide the following response in {language}: ",
+    )
+    response = model.generate_content([prompt], endpoint=SEASONAL_INSIGHTS.endpoint)
+    return clean_response_text(response.text)
+
+def precomputed_insights(district, state, area):
+    if regional_store is None:
+        return None
+    with span("regional_store"):
+        return regional_store.get(state, district, area, current_season(), CANONICAL_LANGUAGE)
+
+def get_regional_disease_insights(district, state, area):
+    # Precomputed for configured regions, generated (and memoized) for the rest
+    return precomputed_insights(district, state, area) or generate_regional_disease_insights(district, state, area)
+
+@memoize(
+    text_cache,
+    "common-diseases-v1",
+    lambda state, location, area: (
+        normalize_region(state), normalize_text(location), normalize_text(area)
+    ),
+)
+def get_common_diseases(state, location, area):
+    region_prompt = COMMON_DISEASES.render(area=area, location=location, state=state)
+    response = model.generate_content(region_prompt, endpoint=COMMON_DISEASES.endpoint)
+    return clean_response_text(response.text)
+
+def common_diseases(state, location, area):
+    return precomputed_insights(location, state, area) or get_common_diseases(state, location, area)
+
+def crop_suggestions_prompt(soil_type, ph_level, nutrients, texture, location):
+    return CROP_SUGGESTIONS.render(
+        soil_type=soil_type, ph_level=ph_level, nutrients=nutrients, texture=texture, location=location,
+        json_instructions=json_instructions(CROPS_SCHEMA),
+    )
+
+@memoize(
+    text_cache,
+    "crop-suggestions-v2",
+    lambda soil_type, ph_level, nutrients, texture, location: (
+        normalize_text(soil_type), normalize_ph(ph_level), normalize_text(nutrients),
+        normalize_text(texture), normalize_region(location)
+    ),
+)
+def get_crop_suggestions(soil_type, ph_level, nutrients, texture, location):
+    prompt = crop_suggestions_prompt(soil_type, ph_level, nutrients, texture, location)
+    with span("crop_call"):
+        response = model.generate_content([prompt], endpoint=CROP_SUGGESTIONS.endpoint)
+    with span("parse"):
+        return parse_crops(response.text)
+
+def render_crop_suggestions(soil_type, ph_level, nutrients, texture, location):
+    return render_crops(get_crop_suggestions(soil_type, ph_level, nutrients, texture, location))
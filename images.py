@@ -0,0 +1,97 @@
+import io
+import logging
+import os
+from pathlib import Path
+from tempfile import SpooledTemporaryFile, TemporaryFile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as uploaded
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Uploads stay in memory up to this size, then spill to an anonymous temp file
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", 16 * 1024 * 1024))
+# Every file of a request larger than this goes straight to disk, so a big
+# batch (hundreds of 4-12 MB photos) holds none of them in memory
+UPLOAD_MEMORY_LIMIT = int(os.getenv("UPLOAD_MEMORY_LIMIT", 64 * 1024 * 1024))
+
+# Downscaling applied before an image is sent to the model
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") != "0"
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", 1024))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+
+MAGIC_NUMBERS = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+def spooled_upload_stream(total_content_length=None):
+    if total_content_length is not None and total_content_length > UPLOAD_MEMORY_LIMIT:
+        return TemporaryFile(mode="w+b")
+    return SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode="w+b")
+
+def read_image_data(source):
+    # source may be a file path, raw bytes or a binary file-like object
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+    elif hasattr(source, "read"):
+        if hasattr(source, "seek"):
+            source.seek(0)
+        data = source.read()
+    else:
+        image_path = Path(source)
+        if not image_path.exists():
+            raise FileNotFoundError(f"Could not find image: {image_path}")
+        data = image_path.read_bytes()
+    return {"mime_type": sniff_mime_type(data), "data": data}
+
+def sniff_mime_type(data):
+    for magic, mime_type in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return "image/jpeg"
+
+def preprocess_image_data(image_data):
+    # Downscale to IMAGE_MAX_EDGE and re-encode as JPEG without metadata.
+    # JPEGs are decoded in draft mode, so the decoder itself scales by 1/2..1/8
+    # and never materialises the full-resolution bitmap. An upload that is
+    # already a small enough JPEG without EXIF (orientation, GPS) is sent as
+    # is, as is any EXIF-free image the re-encode wouldn't shrink: a second
+    # lossy pass only costs quality.
+    if not IMAGE_PREPROCESS or Image is None:
+        return image_data
+
+    original = image_data["data"]
+    try:
+        with Image.open(io.BytesIO(original)) as image:
+            has_exif = bool(image.info.get("exif")) or bool(image.getexif())
+            if image.format == "JPEG" and max(image.size) <= IMAGE_MAX_EDGE and not has_exif:
+                return image_data
+            image.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning("Image preprocessing failed, sending original: %s", e)
+        return image_data
+
+    data = output.getvalue()
+    if len(data) >= len(original) and not has_exif:
+        return image_data
+    logger.info(
+        "Preprocessed image: %d -> %d bytes (%d saved)",
+        len(original), len(data), len(original) - len(data),
+    )
+    return {"mime_type": "image/jpeg", "data": data}
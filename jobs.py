@@ -0,0 +1,411 @@
+import contextvars
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import socket
+import sqlite3
+import ssl
+import threading
+import time
+import urllib.parse
+import uuid
+
+from ratelimit import BATCH, request_priority
+
+logger = logging.getLogger(__name__)
+
+# Durable job queue for clients on flaky connections: a submit is stored in
+# SQLite and answered with a job id straight away, worker threads run it, and
+# the result waits in the database to be polled or is POSTed to the job's
+# callback URL. Jobs survive restarts and dropped connections; a job claimed
+# by a worker that died is picked up again once its lease runs out. Every
+# process that serves requests runs JOB_WORKERS workers on the shared file,
+# by default in the user's state directory rather than the working directory.
+JOBS_PATH = os.getenv("JOBS_PATH") or os.path.join(
+    os.getenv("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state"),
+    "plantpal", "jobs.sqlite3",
+)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 4))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 5))
+# A running job whose worker hasn't finished it by then is run again
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 300))
+# Finished jobs (and their results) are kept this long
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 7 * 24 * 3600))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+JOB_MAX_WAIT = float(os.getenv("JOB_MAX_WAIT", 30))
+
+# Callbacks: POSTed as JSON, signed with JOB_CALLBACK_SECRET when it is set
+# (X-PlantPal-Signature: sha256=<hex HMAC of the body>). JOB_CALLBACK_HOSTS,
+# comma-separated, restricts the hosts jobs may call back; without it any
+# host is allowed whose addresses are all public, so a callback can't reach
+# loopback, private or link-local services (JOB_CALLBACK_ALLOW_PRIVATE=1 lifts
+# that, e.g. for local development). The connection goes to the address that
+# was checked, so DNS can't answer differently in between. Redirects are not
+# followed.
+JOB_CALLBACK_SECRET = os.getenv("JOB_CALLBACK_SECRET")
+JOB_CALLBACK_HOSTS = {host.strip().lower() for host in os.getenv("JOB_CALLBACK_HOSTS", "").split(",") if host.strip()}
+JOB_CALLBACK_ALLOW_PRIVATE = os.getenv("JOB_CALLBACK_ALLOW_PRIVATE", "0") != "0"
+JOB_CALLBACK_ATTEMPTS = int(os.getenv("JOB_CALLBACK_ATTEMPTS", 5))
+JOB_CALLBACK_TIMEOUT = float(os.getenv("JOB_CALLBACK_TIMEOUT", 10))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+class JobError(ValueError):
+    # The message is shown to the client as is
+    pass
+
+def is_public_address(address):
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+def validate_callback_url(url):
+    # Checked on submit and again before every delivery, as DNS may change.
+    # Returns the checked address to connect to, or None when the host is
+    # trusted as is (allowlisted, or private addresses allowed).
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise JobError("callback_url must be an http(s) URL")
+    host = parsed.hostname.lower()
+    if JOB_CALLBACK_HOSTS:
+        if host not in JOB_CALLBACK_HOSTS:
+            raise JobError("callback_url host is not allowed")
+        return None
+    if JOB_CALLBACK_ALLOW_PRIVATE:
+        return None
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, parsed.port or None, proto=socket.IPPROTO_TCP)]
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise JobError("callback_url host could not be resolved")
+    if not addresses or not all(is_public_address(address) for address in addresses):
+        raise JobError("callback_url host is not allowed")
+    return addresses[0]
+
+def retry_delay(attempt, base=JOB_RETRY_BACKOFF):
+    return base * (2 ** (attempt - 1))
+
+class JobQueue:
+    def __init__(self, path=JOBS_PATH, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS,
+                 lease_seconds=JOB_LEASE_SECONDS):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(threading.Lock())
+        self._conn = None
+        self._pid = None
+        self._started_pid = None
+
+    def register(self, kind, handler, permanent_errors=()):
+        # handler(params, payload) returns a JSON-serializable result;
+        # permanent_errors fail the job at once instead of retrying it
+        self._handlers[kind] = (handler, permanent_errors)
+
+    def _connection(self):
+        # Opened on first use and again after a fork, like SQLiteCache
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, dedup_key TEXT UNIQUE, params TEXT NOT NULL, "
+                "payload BLOB, status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "run_after REAL NOT NULL, lease_expires REAL, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_runnable ON jobs (status, run_after)")
+            # One row per submitter's callback URL; due while after is set
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_callbacks ("
+                "job_id TEXT NOT NULL, url TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, after REAL, "
+                "PRIMARY KEY (job_id, url))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS job_callbacks_due ON job_callbacks (after)")
+        return self._conn
+
+    def submit(self, kind, params, payload=None, dedup_key=None, callback_url=None):
+        # Returns (job, created). A submit with the dedup_key of a queued,
+        # running or finished job returns that job instead, so a client that
+        # reconnects and retries never pays for a second run; a failed one is
+        # queued again.
+        if kind not in self._handlers:
+            raise JobError(f"Unknown job kind: {kind}")
+        if callback_url:
+            validate_callback_url(callback_url)
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT id, status FROM jobs WHERE dedup_key = ?", (dedup_key,)
+                ).fetchone() if dedup_key else None
+                if row is None:
+                    job_id = uuid.uuid4().hex
+                    status = QUEUED
+                    conn.execute(
+                        "INSERT INTO jobs (id, kind, dedup_key, params, payload, status, run_after, "
+                        "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (job_id, kind, dedup_key, json.dumps(params), payload, status, now, now, now),
+                    )
+                    created = True
+                else:
+                    job_id, status = row
+                    if status == FAILED:
+                        status = QUEUED
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, attempts = 0, run_after = ?, error = NULL, "
+                            "payload = COALESCE(payload, ?), params = ?, updated_at = ? WHERE id = ?",
+                            (status, now, payload, json.dumps(params), now, job_id),
+                        )
+                    created = False
+                if callback_url:
+                    # Every submitter keeps its own callback; one sent for a
+                    # job that has already finished is due right away
+                    conn.execute(
+                        "INSERT OR IGNORE INTO job_callbacks (job_id, url, after) VALUES (?, ?, ?)",
+                        (job_id, callback_url, now if status == DONE else None),
+                    )
+        self.start_workers()
+        self._notify()
+        return self.get(job_id), created
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT id, kind, status, attempts, result, error, created_at, updated_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job_id, kind, status, attempts, result, error, created_at, updated_at = row
+        job = {
+            "job_id": job_id, "kind": kind, "status": status, "attempts": attempts,
+            "created_at": created_at, "updated_at": updated_at,
+        }
+        if status == DONE:
+            job["result"] = json.loads(result)
+        if error is not None:
+            job["error"] = error
+        return job
+
+    def wait(self, job_id, timeout):
+        # Long poll: the job as soon as it has finished, or as it is at timeout
+        deadline = time.monotonic() + min(timeout, JOB_MAX_WAIT)
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] in (DONE, FAILED) or time.monotonic() >= deadline:
+                return job
+            time.sleep(JOB_POLL_INTERVAL)
+
+    def stats(self):
+        with self._lock:
+            rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    def _claim(self):
+        # Next runnable job, or a running one whose worker's lease ran out
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            # Cheap read first, so idle workers don't queue for the write lock
+            if conn.execute(
+                "SELECT 1 FROM jobs WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_expires < ?) LIMIT 1",
+                (QUEUED, now, RUNNING, now),
+            ).fetchone() is None:
+                return None
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT id, kind, params, payload, attempts FROM jobs "
+                    "WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_expires < ?) "
+                    "ORDER BY run_after LIMIT 1",
+                    (QUEUED, now, RUNNING, now),
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_expires = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    (RUNNING, now + self.lease_seconds, now, row[0]),
+                )
+        job_id, kind, params, payload, attempts = row
+        return job_id, kind, json.loads(params), payload, attempts + 1
+
+    def _finish(self, job_id, status, result=None, error=None, retry_at=None):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                if retry_at is not None:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, run_after = ?, lease_expires = NULL, error = ?, "
+                        "updated_at = ? WHERE id = ?",
+                        (QUEUED, retry_at, error, now, job_id),
+                    )
+                else:
+                    # The upload is only kept while the job may still run
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, result = ?, error = ?, payload = CASE WHEN ? = ? "
+                        "THEN NULL ELSE payload END, lease_expires = NULL, updated_at = ? WHERE id = ?",
+                        (status, result, error, status, DONE, now, job_id),
+                    )
+                    conn.execute(
+                        "UPDATE job_callbacks SET attempts = 0, after = ? WHERE job_id = ?", (now, job_id)
+                    )
+                expired = (DONE, FAILED, now - JOB_RETENTION)
+                conn.execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ? AND id NOT IN "
+                    "(SELECT job_id FROM job_callbacks WHERE after IS NOT NULL)",
+                    expired,
+                )
+                conn.execute("DELETE FROM job_callbacks WHERE job_id NOT IN (SELECT id FROM jobs)")
+
+    def run_one(self):
+        # Claims and runs a single job; False when there was nothing to do
+        claimed = self._claim()
+        if claimed is None:
+            return False
+        job_id, kind, params, payload, attempt = claimed
+        handler, permanent_errors = self._handlers[kind]
+        try:
+            result = handler(params, payload)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            if isinstance(e, permanent_errors) or attempt >= self.max_attempts:
+                logger.warning("Job %s failed after %d attempt(s): %s", job_id, attempt, error)
+                self._finish(job_id, FAILED, error=error)
+            else:
+                self._finish(job_id, QUEUED, error=error, retry_at=time.time() + retry_delay(attempt))
+            return True
+        self._finish(job_id, DONE, result=json.dumps(result, ensure_ascii=False))
+        return True
+
+    def _claim_callback(self):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            if conn.execute(
+                "SELECT 1 FROM job_callbacks WHERE after <= ? LIMIT 1", (now,)
+            ).fetchone() is None:
+                return None
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(
+                    "SELECT job_id, url, attempts FROM job_callbacks "
+                    "WHERE after IS NOT NULL AND after <= ? ORDER BY after LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+                # Held off for the timeout while this worker delivers it
+                conn.execute(
+                    "UPDATE job_callbacks SET attempts = attempts + 1, after = ? WHERE job_id = ? AND url = ?",
+                    (now + JOB_CALLBACK_TIMEOUT * 2, row[0], row[1]),
+                )
+        return row[0], row[1], row[2] + 1
+
+    def deliver_one(self):
+        # POSTs one due callback; False when there was nothing to do
+        claimed = self._claim_callback()
+        if claimed is None:
+            return False
+        job_id, url, attempt = claimed
+        try:
+            post_callback(url, self.get(job_id))
+            next_attempt = None
+        except Exception as e:
+            if attempt >= JOB_CALLBACK_ATTEMPTS:
+                logger.warning("Giving up on callback for job %s: %s", job_id, e)
+                next_attempt = None
+            else:
+                next_attempt = time.time() + retry_delay(attempt)
+        with self._lock:
+            self._connection().execute(
+                "UPDATE job_callbacks SET after = ? WHERE job_id = ? AND url = ?", (next_attempt, job_id, url)
+            )
+        return True
+
+    def start_workers(self):
+        # Once per process, on first use, so forked workers start their own
+        with self._lock:
+            if self._started_pid == os.getpid() or not self.workers:
+                return
+            self._started_pid = os.getpid()
+        for index in range(self.workers):
+            threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True).start()
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _work(self):
+        # Jobs yield upstream quota to interactive requests (see ratelimit.py)
+        context = contextvars.copy_context()
+        context.run(request_priority.set, BATCH)
+        while True:
+            try:
+                ran = context.run(self.run_one)
+                busy = self.deliver_one() or ran
+            except Exception:
+                logger.exception("Job worker error")
+                busy = False
+            if not busy:
+                with self._wakeup:
+                    self._wakeup.wait(JOB_POLL_INTERVAL)
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    # Connects to `address`, the checked IP (or the host itself when it is
+    # trusted); the Host header still names the host
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class _PinnedHTTPSConnection(_PinnedHTTPConnection):
+    default_port = http.client.HTTPS_PORT
+    ssl_context = ssl.create_default_context()
+
+    def connect(self):
+        # The certificate is checked against the host name (and sent as SNI)
+        super().connect()
+        self.sock = self.ssl_context.wrap_socket(self.sock, server_hostname=self.host)
+
+def post_callback(url, job):
+    address = validate_callback_url(url)
+    body = json.dumps(job, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if JOB_CALLBACK_SECRET:
+        signature = hmac.new(JOB_CALLBACK_SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        headers["X-PlantPal-Signature"] = f"sha256={signature}"
+    parsed = urllib.parse.urlparse(url)
+    connection_class = _PinnedHTTPSConnection if parsed.scheme == "https" else _PinnedHTTPConnection
+    # http.client takes IPv6 literals bracketed, as in the URL
+    host = f"[{parsed.hostname}]" if ":" in parsed.hostname else parsed.hostname
+    connection = connection_class(host, address or parsed.hostname, port=parsed.port, timeout=JOB_CALLBACK_TIMEOUT)
+    target = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+    try:
+        # http.client never follows redirects, which could point the
+        # callback at an address validation rejects
+        connection.request("POST", target, body, headers)
+        response = connection.getresponse()
+        response.read()
+        if not 200 <= response.status < 300:
+            raise OSError(f"Callback answered HTTP {response.status}")
+    finally:
+        connection.close()
@@ -0,0 +1,242 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+# Minimal Prometheus-style metrics and per-stage timing spans. With
+# METRICS_ENABLED=0 every call below returns immediately, so instrumented hot
+# paths cost a flag check. METRICS_LOG=1 also writes one JSON timing line per
+# request, with its token spend per endpoint, to the "plantpal.timing" logger.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+METRICS_LOG = os.getenv("METRICS_LOG", "0") != "0"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger("plantpal.timing")
+
+registry = []
+
+# Stage durations of the request being served, shared with worker threads
+# that run with a copy of the request's context
+request_timings = contextvars.ContextVar("request_timings", default=None)
+# Model tokens spent by the request, per endpoint (see prompts.py)
+request_tokens = contextvars.ContextVar("request_tokens", default=None)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._values.items()):
+                cumulative = 0
+                bounds = [*(f"{bound:g}" for bound in self.buckets), "+Inf"]
+                for bound, count in zip(bounds, series):
+                    cumulative += count
+                    labels = format_labels((*self.labels, "le"), (*label_values, bound))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-1]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Gauge:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def set(self, value, *label_values):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+REQUEST_SECONDS = Histogram(
+    "plantpal_request_seconds", "HTTP request latency", ("route", "status")
+)
+STAGE_SECONDS = Histogram(
+    "plantpal_stage_seconds", "Time spent in each request stage", ("stage",)
+)
+UPSTREAM_CALLS = Counter(
+    "plantpal_upstream_calls_total", "Model API calls", ("mode", "outcome")
+)
+UPSTREAM_ERRORS = Counter(
+    "plantpal_upstream_errors_total", "Model API errors by exception type", ("type",)
+)
+TOKENS = Counter(
+    "plantpal_tokens_total", "Model tokens, input and output", ("direction",)
+)
+ENDPOINT_TOKENS = Counter(
+    "plantpal_endpoint_tokens_total", "Model tokens per prompt endpoint", ("endpoint", "direction")
+)
+CACHE_REQUESTS = Counter(
+    "plantpal_cache_requests_total", "Cache lookups", ("cache", "result")
+)
+STARTUP_SECONDS = Gauge(
+    "plantpal_startup_seconds", "Seconds from start-up to each start-up phase", ("phase",)
+)
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def record_stage(stage, elapsed):
+    STAGE_SECONDS.observe(elapsed, stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + elapsed
+
+class _Span:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_stage(self.stage, time.perf_counter() - self.started)
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+def span(stage):
+    return _Span(stage) if METRICS_ENABLED else NULL_SPAN
+
+def timed_iter(stage, iterable):
+    # Times only the waits on `iterable` (e.g. a streamed upstream call),
+    # not the work the consumer does between chunks
+    if not METRICS_ENABLED:
+        return iterable
+    return _timed_iter(stage, iterable)
+
+def _timed_iter(stage, iterable):
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        record_stage(stage, elapsed)
+
+def record_tokens(endpoint, tokens_in, tokens_out, budget=None):
+    if not METRICS_ENABLED:
+        return
+    ENDPOINT_TOKENS.inc(endpoint, "in", amount=tokens_in)
+    ENDPOINT_TOKENS.inc(endpoint, "out", amount=tokens_out)
+    spent = request_tokens.get()
+    if spent is not None:
+        totals = spent.setdefault(endpoint, {"in": 0, "out": 0})
+        totals["in"] += tokens_in
+        totals["out"] += tokens_out
+    elif METRICS_LOG:
+        # Outside a request, e.g. the regional store refresher
+        logger.info(json.dumps({"endpoint": endpoint, "tokens_in": tokens_in, "tokens_out": tokens_out,
+                                "budget": budget}))
+
+def start_request():
+    if not METRICS_ENABLED:
+        return None
+    return request_timings.set({}), request_tokens.set({}), time.perf_counter()
+
+def finish_request(handle, route, status):
+    if handle is None:
+        return
+    timings_token, tokens_token, started = handle
+    total = time.perf_counter() - started
+    timings = request_timings.get()
+    spent = request_tokens.get()
+    request_timings.reset(timings_token)
+    request_tokens.reset(tokens_token)
+    REQUEST_SECONDS.observe(total, route, status)
+    if METRICS_LOG:
+        logger.info(json.dumps({
+            "route": route,
+            "status": status,
+            "total_ms": round(total * 1000, 2),
+            "stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()},
+            "tokens": spent,
+        }))
@@ -0,0 +1,107 @@
+import io
+import itertools
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+import prescreen
+
+# Near-duplicate lookup for uploads: the same plant photographed again, or
+# the same photo re-compressed by a messenger app, has a different SHA-256 but
+# almost the same 64-bit perceptual hash. Hashes within PHASH_MAX_DISTANCE
+# bits reuse the earlier diagnosis.
+PHASH_INDEX = os.getenv("PHASH_INDEX", "1") != "0"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))
+PHASH_INDEX_MAX_ENTRIES = int(os.getenv("PHASH_INDEX_MAX_ENTRIES", 100_000))
+
+class PHashIndex:
+    # Multi-index hashing: each hash is split into `substrings` chunks with one
+    # table per chunk. Two hashes within max_distance bits must differ by at
+    # most max_distance // substrings bits in some chunk (pigeonhole), so a
+    # lookup only probes chunk values that close and checks those candidates.
+    # Entries are grouped (e.g. by language and region) and evicted LRU.
+    def __init__(self, max_entries=PHASH_INDEX_MAX_ENTRIES, max_distance=PHASH_MAX_DISTANCE,
+                 bits=64, substrings=4):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.substrings = substrings
+        self.width = bits // substrings
+        self.mask = (1 << self.width) - 1
+        radius = max_distance // substrings
+        self._probes = [0] + [
+            sum(1 << bit for bit in flipped)
+            for distance in range(1, radius + 1)
+            for flipped in itertools.combinations(range(self.width), distance)
+        ]
+        self._entries = OrderedDict()
+        self._tables = [{} for _ in range(substrings)]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _chunks(self, image_hash):
+        return [(image_hash >> (i * self.width)) & self.mask for i in range(self.substrings)]
+
+    def add(self, image_hash, group, value):
+        key = (group, image_hash)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._entries[key] = value
+                return
+            self._entries[key] = value
+            for table, chunk in zip(self._tables, self._chunks(image_hash)):
+                table.setdefault((group, chunk), set()).add(image_hash)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        (group, image_hash), _ = self._entries.popitem(last=False)
+        for table, chunk in zip(self._tables, self._chunks(image_hash)):
+            bucket = table[(group, chunk)]
+            bucket.discard(image_hash)
+            if not bucket:
+                del table[(group, chunk)]
+
+    def get(self, image_hash, group):
+        # Value of the closest indexed hash within max_distance, or None
+        best, best_distance = None, self.max_distance + 1
+        with self._lock:
+            for table, chunk in zip(self._tables, self._chunks(image_hash)):
+                for probe in self._probes:
+                    for candidate in table.get((group, chunk ^ probe), ()):
+                        distance = (candidate ^ image_hash).bit_count()
+                        if distance < best_distance:
+                            best, best_distance = candidate, distance
+            if best is None:
+                self.misses += 1
+                metrics.CACHE_REQUESTS.inc("phash_index", "miss")
+                return None
+            key = (group, best)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.CACHE_REQUESTS.inc("phash_index", "hit")
+            return self._entries[key]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+def image_phash(data, screening=None):
+    # Reuses the pre-screen's hash when it already decoded the image; None
+    # when the index is off, NumPy/Pillow are missing or decoding fails.
+    # Callers pass the preprocessed (downscaled JPEG) copy, which the
+    # decoder's draft mode reads at 1/8 scale.
+    if not PHASH_INDEX or not prescreen.imaging_available():
+        return None
+    if screening is not None:
+        return screening["features"]["phash"]
+    try:
+        with prescreen.Image.open(io.BytesIO(data)) as image:
+            image.draft("L", (64, 64))
+            # Formats without draft mode (e.g. PNG when preprocessing is
+            # off) are reduced before the hash's Lanczos resize
+            image.thumbnail((128, 128))
+            return prescreen.phash(image)
+    except Exception:
+        return None
@@ -0,0 +1,178 @@
+import io
+import json
+import logging
+import math
+import os
+
+# NumPy and Pillow are optional and imported on the first screened image
+# rather than at start-up; without them nothing is screened
+np = Image = None
+_imaging_missing = False
+
+logger = logging.getLogger(__name__)
+
+# Optional on-CPU pre-screen run before the vision call. Cheap image features
+# (sharpness, colour ratios, perceptual hash) reject photos the model can't
+# help with, and a tiny logistic classifier answers obviously healthy leaves
+# from a template without an upstream call.
+PRESCREEN = os.getenv("PRESCREEN", "0") != "0"
+PRESCREEN_EDGE = int(os.getenv("PRESCREEN_EDGE", 256))
+PRESCREEN_MIN_EDGE = int(os.getenv("PRESCREEN_MIN_EDGE", 64))
+PRESCREEN_MIN_SHARPNESS = float(os.getenv("PRESCREEN_MIN_SHARPNESS", 15))
+PRESCREEN_MIN_PLANT_RATIO = float(os.getenv("PRESCREEN_MIN_PLANT_RATIO", 0.15))
+PRESCREEN_HEALTHY_THRESHOLD = float(os.getenv("PRESCREEN_HEALTHY_THRESHOLD", 0.95))
+# Evidence of a real leaf that the healthy answer also needs, whatever the
+# classifier says: most green pixels must show texture (veins, surface
+# detail), and the greens must vary in hue. Flat-filled logos and synthetic
+# images have neither; leaf photos are at 0.8-0.9 and 18-20 degrees.
+PRESCREEN_MIN_GREEN_TEXTURE = float(os.getenv("PRESCREEN_MIN_GREEN_TEXTURE", 0.5))
+PRESCREEN_MIN_HUE_SPREAD = float(os.getenv("PRESCREEN_MIN_HUE_SPREAD", 3))
+# JSON file with {"features": [...], "weights": [...], "bias": b} fitted offline
+PRESCREEN_WEIGHTS = os.getenv("PRESCREEN_WEIGHTS")
+
+# Conservative hand-set defaults: only large, green, sharp leaves with almost
+# no yellow, brown or dark patches score above the threshold
+DEFAULT_MODEL = {
+    "features": ["green_ratio", "lesion_ratio", "dark_ratio", "sharpness"],
+    "weights": [6.0, -30.0, -8.0, 0.5],
+    "bias": -2.0,
+}
+
+# Pillow's HSV channels are 0-255; hue 0-255 spans 0-360 degrees
+HUE_SCALE = 360 / 255
+LESION_HUES = (15, 60)
+GREEN_HUES = (60, 170)
+MIN_SATURATION = 51
+MIN_VALUE = 38
+# Laplacian magnitude (grey levels) that counts a pixel as textured
+TEXTURE_MIN_CONTRAST = 4
+
+def imaging_available():
+    global np, Image, _imaging_missing
+    if np is None and not _imaging_missing:
+        try:
+            import numpy
+            from PIL import Image as PILImage
+        except ImportError:
+            _imaging_missing = True
+        else:
+            # Image first: other threads check np before using both
+            Image, np = PILImage, numpy
+    return np is not None
+
+class ImageRejected(ValueError):
+    # The message is shown to the user as is
+    pass
+
+def load_model(path=PRESCREEN_WEIGHTS):
+    if not path:
+        return DEFAULT_MODEL
+    with open(path, encoding="utf-8") as model_file:
+        return json.load(model_file)
+
+_model = None
+
+def healthy_probability(features):
+    global _model
+    if _model is None:
+        _model = load_model()
+    z = _model["bias"] + sum(
+        weight * features[name] for name, weight in zip(_model["features"], _model["weights"])
+    )
+    return 1 / (1 + math.exp(-z))
+
+_dct_matrix = None
+
+def phash(image):
+    # 64-bit DCT perceptual hash: low frequencies of a 32x32 greyscale copy,
+    # one bit per coefficient above the median
+    global _dct_matrix
+    if _dct_matrix is None:
+        n = np.arange(32)
+        _dct_matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_dct_matrix @ pixels @ _dct_matrix.T)[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def image_features(data):
+    with Image.open(io.BytesIO(data)) as image:
+        size = image.size
+        image.draft("RGB", (PRESCREEN_EDGE, PRESCREEN_EDGE))
+        image = image.convert("RGB")
+        image.thumbnail((PRESCREEN_EDGE, PRESCREEN_EDGE))
+
+    grey = np.asarray(image.convert("L"), dtype=np.float32)
+    # Variance of the Laplacian: low for blurred or featureless photos
+    laplacian = (
+        4 * grey[1:-1, 1:-1] - grey[:-2, 1:-1] - grey[2:, 1:-1] - grey[1:-1, :-2] - grey[1:-1, 2:]
+    )
+
+    hsv = np.asarray(image.convert("HSV"))
+    hue = hsv[..., 0] * HUE_SCALE
+    coloured = (hsv[..., 1] >= MIN_SATURATION) & (hsv[..., 2] >= MIN_VALUE)
+    green = coloured & (hue >= GREEN_HUES[0]) & (hue < GREEN_HUES[1])
+    lesion = coloured & (hue >= LESION_HUES[0]) & (hue < LESION_HUES[1])
+    pixels = hue.size
+    # Share of green pixels (inside the Laplacian's one-pixel border) with texture
+    inner_green = green[1:-1, 1:-1]
+    textured = np.abs(laplacian[inner_green]) >= TEXTURE_MIN_CONTRAST
+
+    sharpness = float(laplacian.var())
+    return {
+        "width": size[0],
+        "height": size[1],
+        "sharpness": math.log10(1 + sharpness),
+        "raw_sharpness": sharpness,
+        "green_ratio": float(green.sum()) / pixels,
+        "lesion_ratio": float(lesion.sum()) / pixels,
+        "dark_ratio": float((hsv[..., 2] < MIN_VALUE).sum()) / pixels,
+        "hue_spread": float(hue[green].std()) if green.any() else 0.0,
+        "green_texture": float(textured.mean()) if textured.size else 0.0,
+        "phash": phash(image),
+    }
+
+def screen_image(data):
+    # Returns None when screening is off, else a dict whose "verdict" is
+    # "healthy" or "analyse"; unusable photos raise ImageRejected
+    if not PRESCREEN or not imaging_available():
+        return None
+
+    try:
+        features = image_features(data)
+    except Exception as e:
+        logger.info("Pre-screen could not decode upload: %s", e)
+        raise ImageRejected("We could not read this file as an image. Please upload a JPEG or PNG photo.") from None
+
+    if min(features["width"], features["height"]) < PRESCREEN_MIN_EDGE:
+        raise ImageRejected("This image is too small to diagnose. Please upload a larger photo of the leaf.")
+    if features["raw_sharpness"] < PRESCREEN_MIN_SHARPNESS:
+        raise ImageRejected(
+            "This photo looks blurry. Hold the camera steady and focus on the affected leaf, then try again."
+        )
+    if features["green_ratio"] + features["lesion_ratio"] < PRESCREEN_MIN_PLANT_RATIO:
+        raise ImageRejected(
+            "We could not find a plant in this photo. Please take a close-up of the affected leaves."
+        )
+
+    probability = healthy_probability(features)
+    looks_like_leaf = (
+        features["green_texture"] >= PRESCREEN_MIN_GREEN_TEXTURE
+        and features["hue_spread"] >= PRESCREEN_MIN_HUE_SPREAD
+    )
+    verdict = "healthy" if looks_like_leaf and probability >= PRESCREEN_HEALTHY_THRESHOLD else "analyse"
+    return {"verdict": verdict, "healthy_probability": probability, "features": features}
+
+def healthy_diagnosis(screening):
+    # Templated answer in the structured diagnosis shape (see structured.py);
+    # rendering localizes it, so it never needs translating
+    return {
+        "healthy": True,
+        "disease": None,
+        "confidence": round(screening["healthy_probability"], 2),
+        "severity": "none",
+        "symptoms": [],
+        "treatments": [],
+        "prevention": [],
+        "regional_context": "",
+    }
@@ -0,0 +1,139 @@
+import json
+import math
+import os
+import re
+import string
+
+# Prompt templates and per-endpoint token budgets. Templates are compiled
+# once at import: indentation, blank lines and runs of spaces are stripped
+# from their text (the model doesn't need them, and every one is billed as
+# input tokens) and the text is split into literal and field parts, so
+# rendering is a single join. Every upstream call names its endpoint, which
+# selects its output budget (max_output_tokens) and labels its token spend.
+
+# Output tokens allowed per endpoint, sized to the answer each prompt asks
+# for rather than the model-wide 4096. JSON answers get headroom: a truncated
+# object fails validation. PROMPT_BUDGETS='{"common_diseases": 300}' overrides.
+OUTPUT_BUDGETS = {
+    "disease_analysis": 1024,
+    "image_diagnosis": 1024,
+    "translation": 1536,
+    "regional_insights": 768,
+    "seasonal_insights": 1024,
+    "crop_suggestions": 1024,
+    # "in under 100 words"
+    "common_diseases": 256,
+}
+OUTPUT_BUDGETS.update(json.loads(os.getenv("PROMPT_BUDGETS", "{}")))
+
+def output_budget(endpoint):
+    # None for unnamed calls, which keep the model's default limit
+    return OUTPUT_BUDGETS.get(endpoint)
+
+# Local input token count, no countTokens round trip. Gemini's vocabulary
+# takes most English words whole and digits one at a time; Indic scripts
+# need roughly a token per two characters, which len(text) // 4 undercounts
+# several times over for translated prompts.
+TOKEN_PIECES = re.compile(r"[A-Za-z]+|[0-9]|[^\x00-\x7f]+|\n|[^\sA-Za-z0-9]")
+
+def count_tokens(text):
+    tokens = 0
+    for piece in TOKEN_PIECES.findall(text):
+        if piece.isascii():
+            tokens += 1 + len(piece) // 10
+        else:
+            tokens += math.ceil(len(piece) / 2)
+    return tokens
+
+def compact(text):
+    return "\n".join(" ".join(line.split()) for line in text.splitlines() if line.strip())
+
+class PromptTemplate:
+    # str.format-style {fields}; values are inserted as given, only the
+    # template's own text is compacted
+    def __init__(self, endpoint, text):
+        self.endpoint = endpoint
+        self.text = compact(text)
+        self._parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(self.text):
+            if spec or conversion:
+                raise ValueError(f"Prompt {endpoint}: format specs are not supported in {{{field}}}")
+            self._parts.append((literal, field))
+
+    def render(self, **values):
+        return "".join(
+            literal if field is None else literal + str(values[field]) for literal, field in self._parts
+        )
+
+DISEASE_ANALYSIS = PromptTemplate("disease_analysis", """
+    As a highly skilled plant pathologist, analyze this plant image for a farmer in {area}, {district}, {state}.
+    Identify the disease (if any), assess its severity and recommend treatments.
+    List preventive measures suited to the local climate and common agricultural practices in {state}.
+    In regional_context, say whether this disease is common in {district} and what factors in this region might affect its spread.
+    Be concise and practical.
+
+    {json_instructions}
+""")
+
+IMAGE_DIAGNOSIS = PromptTemplate("image_diagnosis", """
+    As a highly skilled plant pathologist, analyze this plant image.
+    Identify the disease (if any), assess its severity and recommend treatments.
+    Be concise and practical.
+
+    {json_instructions}
+""")
+
+TRANSLATION = PromptTemplate("translation", """
+    Translate every string value of this plant diagnosis from {source_language} into {language} for a farmer.
+    Keep the keys, booleans, numbers and the severity value exactly as they are.
+
+    {diagnosis_json}
+
+    {json_instructions}
+""")
+
+REGIONAL_INSIGHTS = PromptTemplate("regional_insights", """
+    As an agricultural expert, provide insights about plant diseases in {area}, {district}, {state}:
+    1. What are the most common plant diseases in this region?
+    2. Which seasons are these diseases most prevalent?
+    3. What are the unique environmental factors in {district} that affect plant health?
+    4. What preventive measures do you recommend for farmers in this specific area?
+
+    Provide a concise, practical response focusing on local relevance.
+""")
+
+# For the precomputed store; language_instruction is empty for the canonical language
+SEASONAL_INSIGHTS = PromptTemplate("seasonal_insights", """
+    {language_instruction}As an agricultural expert, provide insights about plant diseases in {area}, {district}, {state}
+    for the {season} season:
+    1. What are the most common plant diseases in this region this season?
+    2. What are the unique environmental factors in {district} that affect plant health?
+    3. What preventive measures do you recommend for farmers in this specific area?
+
+    Provide a concise, practical response focusing on local relevance.
+""")
+
+CROP_SUGGESTIONS = PromptTemplate("crop_suggestions", """
+    As an expert agricultural advisor, based on the following details:
+    - Soil Type: {soil_type}
+    - pH Level: {ph_level}
+    - Nutrient Content: {nutrients}
+    - Soil Texture: {texture}
+    - Location: {location}
+
+    Suggest the best crops that can be planted in this region and soil type.
+    Provide reasons for your suggestions, including compatibility with soil, climate, and market demand.
+    Your response should be concise and farmer-friendly.
+
+    {json_instructions}
+""")
+
+COMMON_DISEASES = PromptTemplate("common_diseases", """
+    As an expert plant pathologist, provide a short and concise response about common plant diseases that affect plants in the region specified below:
+
+    **Area:** {area}
+    **Location:** {location}
+    **State:** {state}
+
+    Focus on providing common diseases relevant to the specified region in under 100 words.
+""")
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+# Client-side governor for the upstream quota. Every model call takes one
+# request from a requests/min bucket and its estimated tokens from a
+# tokens/min bucket, and holds a concurrency slot whose limit adapts AIMD-style
+# to 429s and latency. Callers queue by priority for at most a bounded time.
+INTERACTIVE = 0
+BATCH = 1
+
+request_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "1000"))
+RATE_LIMIT_TPM = float(os.getenv("RATE_LIMIT_TPM", "1000000"))
+RATE_LIMIT_BURST_SECONDS = float(os.getenv("RATE_LIMIT_BURST_SECONDS", "10"))
+CONCURRENCY_INITIAL = int(os.getenv("CONCURRENCY_INITIAL", "16"))
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", "1"))
+CONCURRENCY_MAX = int(os.getenv("CONCURRENCY_MAX", "64"))
+LATENCY_TARGET = float(os.getenv("LATENCY_TARGET", "15"))
+QUEUE_MAX_WAIT = {
+    INTERACTIVE: float(os.getenv("QUEUE_MAX_WAIT_INTERACTIVE", "10")),
+    BATCH: float(os.getenv("QUEUE_MAX_WAIT_BATCH", "300")),
+}
+
+# Waiters re-check at least this often; async waiters cannot be notified
+POLL_INTERVAL = 0.05
+
+class RateLimitExceeded(Exception):
+    # Same code as an upstream 429, so retry logic treats both alike
+    code = 429
+
+    def __init__(self, retry_after):
+        super().__init__(f"Model quota is busy, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=RATE_LIMIT_BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Requests bigger than the burst only need a full bucket, not more
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount):
+        # May go negative when a call turns out to cost more than estimated
+        self.tokens -= amount
+
+class AdaptiveConcurrency:
+    def __init__(self, initial=CONCURRENCY_INITIAL, minimum=CONCURRENCY_MIN,
+                 maximum=CONCURRENCY_MAX, latency_target=LATENCY_TARGET):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+
+    def has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    def on_success(self, latency):
+        if latency > self.latency_target:
+            self.limit = max(self.minimum, self.limit * 0.9)
+        else:
+            # Additive increase: about +1 per limit's worth of completions
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_rate_limited(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
+class RateGovernor:
+    def __init__(self, rpm=RATE_LIMIT_RPM, tpm=RATE_LIMIT_TPM, concurrency=None, max_wait=None):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = concurrency or AdaptiveConcurrency()
+        self.max_wait = max_wait or QUEUE_MAX_WAIT
+        self.rejected = 0
+        self.rate_limited = 0
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+
+    def acquire(self, tokens, priority=None):
+        # The caller must release() exactly once after a successful acquire
+        ticket, deadline = self._enqueue(tokens, priority)
+        try:
+            with self._cond:
+                while True:
+                    wait = self._try_admit(ticket)
+                    if wait == 0:
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(ticket, wait)
+                    self._cond.wait(min(wait, remaining))
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    async def acquire_async(self, tokens, priority=None):
+        ticket, deadline = self._enqueue(tokens, priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(ticket)
+                    if wait == 0:
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(ticket, wait)
+                await asyncio.sleep(min(wait, remaining, POLL_INTERVAL))
+        except BaseException:
+            # Cancelled while queued: a ticket left at the head of the queue
+            # would block everyone behind it
+            self._abandon(ticket)
+            raise
+
+    def release(self, latency=None, rate_limited=False, extra_tokens=0):
+        with self._cond:
+            self.concurrency.in_flight -= 1
+            if rate_limited:
+                self.rate_limited += 1
+                self.concurrency.on_rate_limited()
+            elif latency is not None:
+                self.concurrency.on_success(latency)
+            if extra_tokens:
+                self.tokens.consume(extra_tokens)
+            self._cond.notify_all()
+
+    def has_capacity(self):
+        # Whether a new call would be admitted without queueing for a slot
+        with self._cond:
+            return not self._queue and self.concurrency.has_capacity()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "concurrency_limit": round(self.concurrency.limit, 2),
+                "in_flight": self.concurrency.in_flight,
+                "queued": len(self._queue),
+                "rejected": self.rejected,
+                "rate_limited": self.rate_limited,
+            }
+
+    def _enqueue(self, tokens, priority):
+        if priority is None:
+            priority = request_priority.get()
+        ticket = [priority, next(self._seq), tokens]
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+        return ticket, time.monotonic() + self.max_wait[priority]
+
+    def _try_admit(self, ticket):
+        # Returns 0 once admitted, otherwise how long to wait before retrying.
+        # Only the head of the priority queue may be admitted.
+        if self._queue[0] is not ticket or not self.concurrency.has_capacity():
+            return POLL_INTERVAL
+        now = time.monotonic()
+        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(ticket[2], now))
+        if wait > 0:
+            return wait
+        heapq.heappop(self._queue)
+        self.requests.consume(1)
+        self.tokens.consume(ticket[2])
+        self.concurrency.in_flight += 1
+        self._cond.notify_all()
+        return 0
+
+    def _reject(self, ticket, retry_after):
+        self._remove(ticket)
+        self.rejected += 1
+        raise RateLimitExceeded(max(1.0, retry_after))
+
+    def _abandon(self, ticket):
+        # No-op for a ticket that was already admitted or rejected
+        with self._cond:
+            self._remove(ticket)
+
+    def _remove(self, ticket):
+        self._queue = [queued for queued in self._queue if queued is not ticket]
+        heapq.heapify(self._queue)
+        self._cond.notify_all()
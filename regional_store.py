@@ -0,0 +1,258 @@
+import argparse
+import contextvars
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # non-POSIX: every process refreshes on its own
+    fcntl = None
+
+from cache import normalize_region, normalize_text
+from ratelimit import BATCH, request_priority
+
+logger = logging.getLogger(__name__)
+
+# Precomputed regional insights. A batch job generates insights for every
+# configured (state, district, area, season, language) into one compact file:
+# an open-addressing hash table followed by the UTF-8 records. Every worker
+# memory-maps it read-only, so a request-time lookup is a few struct reads,
+# and picks up a rebuilt file on its next check. A background refresher
+# regenerates the stalest entries a batch at a time.
+REGIONAL_STORE_PATH = os.getenv("REGIONAL_STORE_PATH")
+# JSON: {"regions": [{"state", "district", "area"}, ...], "seasons": [...], "languages": [...]}
+REGIONAL_TARGETS = os.getenv("REGIONAL_TARGETS")
+REGIONAL_REFRESH = os.getenv("REGIONAL_REFRESH", "1") != "0"
+REGIONAL_REFRESH_INTERVAL = float(os.getenv("REGIONAL_REFRESH_INTERVAL", 3600))
+REGIONAL_REFRESH_BATCH = int(os.getenv("REGIONAL_REFRESH_BATCH", 50))
+REGIONAL_MAX_AGE = float(os.getenv("REGIONAL_MAX_AGE", 30 * 24 * 3600))
+REGIONAL_STORE_CHECK = float(os.getenv("REGIONAL_STORE_CHECK", 5))
+
+SEASONS = ("kharif", "rabi", "zaid")
+
+MAGIC = b"PPRI"
+VERSION = 1
+# magic, version, slot count, entry count, built at
+HEADER = struct.Struct("<4sIIId")
+# key hash (0 = empty), record offset, record length, generated at
+SLOT = struct.Struct("<QIId")
+KEY_SEPARATOR = "\x1e"
+
+def current_season(today=None):
+    # Indian cropping seasons: kharif with the monsoon, rabi over winter,
+    # zaid in the short summer between them
+    month = (today or datetime.date.today()).month
+    if 6 <= month <= 10:
+        return "kharif"
+    if month >= 11 or month <= 3:
+        return "rabi"
+    return "zaid"
+
+def make_key(state, district, area, season, language):
+    return "\x1f".join([
+        normalize_region(state), normalize_text(district), normalize_text(area),
+        normalize_text(season), normalize_text(language),
+    ])
+
+def key_hash(key):
+    value = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+    return value or 1
+
+def write_store(path, entries):
+    # entries maps key -> (text, generated_at). The file is written aside and
+    # renamed into place, so readers never see a partial table.
+    slot_count = 1
+    while slot_count < max(1, len(entries)) * 2:
+        slot_count *= 2
+    slots = [(0, 0, 0, 0.0)] * slot_count
+    records = []
+    offset = HEADER.size + SLOT.size * slot_count
+
+    for key, (text, generated_at) in entries.items():
+        record = (key + KEY_SEPARATOR + text).encode("utf-8")
+        index = key_hash(key) & (slot_count - 1)
+        while slots[index][0]:
+            index = (index + 1) & (slot_count - 1)
+        slots[index] = (key_hash(key), offset, len(record), generated_at)
+        records.append(record)
+        offset += len(record)
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as store_file:
+        store_file.write(HEADER.pack(MAGIC, VERSION, slot_count, len(entries), time.time()))
+        for slot in slots:
+            store_file.write(SLOT.pack(*slot))
+        for record in records:
+            store_file.write(record)
+    os.replace(temp_path, path)
+
+class RegionalStore:
+    def __init__(self, path, check_interval=REGIONAL_STORE_CHECK):
+        self.path = path
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._map = None
+        self._slot_count = 0
+        self._identity = None
+        self._checked = 0.0
+        self._refresher = None
+        self._lock = threading.Lock()
+        self._reopen()
+
+    def refresh_in_background(self, targets, generate, interval=REGIONAL_REFRESH_INTERVAL):
+        # Starts on the first lookup, i.e. in the worker process that serves it
+        self._refresher = (targets, generate, interval)
+
+    def _reopen(self):
+        # Maps the current file if it was replaced since the last check
+        self._checked = time.monotonic()
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if identity == self._identity or stat.st_size < HEADER.size:
+            return
+        with open(self.path, "rb") as store_file:
+            mapped = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slot_count, _, _ = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != VERSION:
+            logger.warning("Ignoring %s: not a regional insights store", self.path)
+            return
+        # Readers holding the old map keep it alive until they finish
+        self._map, self._slot_count, self._identity = mapped, slot_count, identity
+
+    def get(self, state, district, area, season, language):
+        if self._refresher is not None:
+            with self._lock:
+                if self._refresher is not None:
+                    start_refresher(self, *self._refresher)
+                    self._refresher = None
+        if time.monotonic() - self._checked > self.check_interval:
+            with self._lock:
+                self._reopen()
+        mapped, slot_count = self._map, self._slot_count
+        if mapped is None:
+            return None
+
+        key = make_key(state, district, area, season, language)
+        wanted = key_hash(key)
+        index = wanted & (slot_count - 1)
+        for _ in range(slot_count):
+            slot_hash, offset, length, _ = SLOT.unpack_from(mapped, HEADER.size + index * SLOT.size)
+            if slot_hash == 0:
+                break
+            if slot_hash == wanted:
+                stored_key, _, text = mapped[offset:offset + length].decode("utf-8").partition(KEY_SEPARATOR)
+                if stored_key == key:
+                    self.hits += 1
+                    return text
+            index = (index + 1) & (slot_count - 1)
+        self.misses += 1
+        return None
+
+    def entries(self):
+        # Every record as key -> (text, generated_at), for incremental rebuilds
+        with self._lock:
+            self._reopen()
+        mapped, slot_count = self._map, self._slot_count
+        entries = {}
+        for index in range(slot_count if mapped is not None else 0):
+            slot_hash, offset, length, generated_at = SLOT.unpack_from(mapped, HEADER.size + index * SLOT.size)
+            if slot_hash:
+                key, _, text = mapped[offset:offset + length].decode("utf-8").partition(KEY_SEPARATOR)
+                entries[key] = (text, generated_at)
+        return entries
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+def load_targets(path):
+    with open(path, encoding="utf-8") as targets_file:
+        config = json.load(targets_file)
+    return [
+        (region["state"], region["district"], region.get("area", ""), season, language)
+        for region, season, language in itertools.product(
+            config["regions"], config.get("seasons", SEASONS), config.get("languages", ["English"])
+        )
+    ]
+
+def refresh(store, targets, generate, batch_size=REGIONAL_REFRESH_BATCH, max_age=REGIONAL_MAX_AGE,
+            wait=True):
+    # Regenerates missing entries first, then the oldest past max_age, at
+    # most batch_size per call; entries no longer targeted are dropped. An
+    # flock keeps concurrent refreshers (workers, the CLI) from overwriting
+    # each other; with wait=False a held lock raises BlockingIOError.
+    with open(f"{store.path}.lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        return _refresh(store, targets, generate, batch_size, max_age)
+
+def _refresh(store, targets, generate, batch_size, max_age):
+    entries = store.entries()
+    now = time.time()
+    keys = {make_key(*target): target for target in targets}
+    due = sorted(
+        (entries.get(key, ("", 0.0))[1], key) for key in keys
+        if key not in entries or now - entries[key][1] > max_age
+    )
+
+    refreshed = 0
+    for _, key in due[:batch_size]:
+        try:
+            entries[key] = (generate(*keys[key]), time.time())
+            refreshed += 1
+        except Exception as e:
+            logger.warning("Could not generate regional insights for %s: %s", keys[key], e)
+
+    if refreshed or entries.keys() - keys.keys():
+        write_store(store.path, {key: entry for key, entry in entries.items() if key in keys})
+    logger.info("Regional store: %d refreshed, %d still due", refreshed, len(due) - refreshed)
+    return refreshed
+
+def start_refresher(store, targets, generate, interval=REGIONAL_REFRESH_INTERVAL):
+    # Daemon thread; across worker processes the lock elects one refresher.
+    # Refreshes yield upstream quota to interactive requests (see ratelimit.py)
+    def run():
+        request_priority.set(BATCH)
+        while True:
+            try:
+                refresh(store, targets, generate, wait=False)
+            except BlockingIOError:
+                pass
+            except Exception:
+                logger.exception("Regional store refresh failed")
+            time.sleep(interval)
+
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(run,), name="regional-refresh", daemon=True)
+    thread.start()
+    return thread
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the precomputed regional insights store")
+    parser.add_argument("--targets", default=REGIONAL_TARGETS, required=not REGIONAL_TARGETS,
+                        help="JSON file listing regions, seasons and languages")
+    parser.add_argument("--out", default=REGIONAL_STORE_PATH, required=not REGIONAL_STORE_PATH,
+                        help="store file to create or update")
+    parser.add_argument("--batch", type=int, default=None,
+                        help="regenerate at most this many entries (default: all that are due)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from generation import generate_seasonal_insights
+
+    targets = load_targets(args.targets)
+    refresh(RegionalStore(args.out), targets, generate_seasonal_insights, batch_size=args.batch or len(targets))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import asyncio
+import contextvars
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from concurrency import is_rate_limited
+from ratelimit import RateLimitExceeded
+
+# Retries with full-jitter exponential backoff, hedged duplicates for calls
+# slower than the observed p95, and a circuit breaker that fails fast while the
+# upstream is degraded. Memoized callers keep serving stale answers meanwhile.
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+HEDGE = os.getenv("HEDGE", "1") != "0"
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))
+# At most this fraction of calls is hedged, with a burst of HEDGE_BURST, so a
+# slow upstream (when nearly every call crosses the old p95) doesn't get
+# twice the load exactly while it is degraded
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", "5"))
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_RESET = float(os.getenv("CIRCUIT_RESET", "30"))
+
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"DeadlineExceeded", "InternalServerError", "ServiceUnavailable", "TooManyRequests"}
+
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "64"))
+
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge-call")
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Model service is degraded, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+# Suggested client back-off for rejections that don't carry their own
+RETRY_AFTER = 30
+
+def error_status(errors):
+    # HTTP status and headers for a request whose upstream calls all failed:
+    # 429 when every failure was a quota rejection, 503 while the circuit
+    # breaker is open (both with Retry-After), else 500
+    errors = list(errors)
+    retry_after = max(getattr(e, "retry_after", RETRY_AFTER) for e in errors)
+    headers = {"Retry-After": str(math.ceil(retry_after))}
+    if all(is_rate_limited(e) for e in errors):
+        return 429, headers
+    if all(isinstance(e, CircuitOpenError) for e in errors):
+        return 503, headers
+    return 500, {}
+
+def is_retryable(error):
+    if isinstance(error, RateLimitExceeded):
+        # Our own governor already waited as long as it is allowed to
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_CODES or type(error).__name__ in RETRYABLE_ERRORS
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+class LatencyTracker:
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def __len__(self):
+        return len(self._samples)
+
+class HedgeBudget:
+    # Every call earns `ratio` of a hedge, up to `burst`; a hedge spends one
+    def __init__(self, ratio=HEDGE_BUDGET, burst=HEDGE_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self._lock = threading.Lock()
+
+    def on_call(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class CircuitBreaker:
+    # Opens after CIRCUIT_FAILURES consecutive upstream failures; after
+    # CIRCUIT_RESET seconds a single probe call decides whether to close again
+    def __init__(self, failures=CIRCUIT_FAILURES, reset_after=CIRCUIT_RESET):
+        self.failure_threshold = failures
+        self.reset_after = reset_after
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            remaining = self.opened_at + self.reset_after - now
+            if remaining <= 0:
+                # Let one probe through; the rest keep failing fast until it
+                # reports back (or, if it never does, until the next probe)
+                self.state = "half-open"
+                self.opened_at = now
+                return
+            self.rejected += 1
+            raise CircuitOpenError(max(1.0, remaining))
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+class ResilientBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.breaker = CircuitBreaker()
+        # Per-attempt upstream latency vs. what callers actually waited
+        self.upstream_latency = LatencyTracker()
+        self.effective_latency = LatencyTracker()
+        self.hedge_budget = HedgeBudget()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        started = time.monotonic()
+        for attempt in range(RETRY_ATTEMPTS):
+            self.breaker.before_call()
+            try:
+                if stream:
+                    response = self.backend.generate_content(contents, stream=True, endpoint=endpoint)
+                else:
+                    response = self._hedged(contents, endpoint)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                self.retries += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            self.breaker.record_success()
+            self.effective_latency.add(time.monotonic() - started)
+            return response
+
+    async def generate_content_async(self, contents, endpoint=None):
+        started = time.monotonic()
+        for attempt in range(RETRY_ATTEMPTS):
+            self.breaker.before_call()
+            try:
+                response = await self._hedged_async(contents, endpoint)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                self.retries += 1
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            self.breaker.record_success()
+            self.effective_latency.add(time.monotonic() - started)
+            return response
+
+    def _should_retry(self, error, attempt):
+        retryable = is_retryable(error)
+        # Quota 429s say nothing about upstream health; other non-retryable
+        # errors (bad request, safety block) mean the upstream answered
+        if retryable and not is_rate_limited(error):
+            self.breaker.record_failure()
+        elif not retryable and not is_rate_limited(error):
+            self.breaker.record_success()
+        return retryable and attempt + 1 < RETRY_ATTEMPTS
+
+    def _hedge_delay(self):
+        if not HEDGE or len(self.upstream_latency) < HEDGE_MIN_SAMPLES:
+            return None
+        self.hedge_budget.on_call()
+        return max(HEDGE_MIN_DELAY, self.upstream_latency.percentile(0.95))
+
+    def _may_hedge(self):
+        # Only with budget left and a free quota slot: a hedge that has to
+        # queue behind the governor can't beat the primary anyway
+        has_capacity = getattr(self.backend, "has_capacity", None)
+        if (has_capacity is not None and not has_capacity()) or not self.hedge_budget.try_spend():
+            self.hedges_skipped += 1
+            return False
+        self.hedges += 1
+        return True
+
+    def _timed_call(self, contents, endpoint):
+        started = time.monotonic()
+        response = self.backend.generate_content(contents, endpoint=endpoint)
+        self.upstream_latency.add(time.monotonic() - started)
+        return response
+
+    async def _timed_call_async(self, contents, endpoint):
+        started = time.monotonic()
+        response = await self.backend.generate_content_async(contents, endpoint=endpoint)
+        self.upstream_latency.add(time.monotonic() - started)
+        return response
+
+    def _submit(self, contents, endpoint):
+        # Carry the caller's context (e.g. its quota priority) into the pool
+        return hedge_executor.submit(contextvars.copy_context().run, self._timed_call, contents, endpoint)
+
+    def _hedged(self, contents, endpoint):
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None:
+            return self._timed_call(contents, endpoint)
+
+        primary = self._submit(contents, endpoint)
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+
+        # The primary is slower than p95: race a duplicate against it
+        if not self._may_hedge():
+            return primary.result()
+        hedge = self._submit(contents, endpoint)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    # A thread can't be interrupted: this only stops a loser
+                    # still queued in the pool from ever calling upstream
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _hedged_async(self, contents, endpoint):
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None:
+            return await self._timed_call_async(contents, endpoint)
+
+        primary = asyncio.ensure_future(self._timed_call_async(contents, endpoint))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+            if done:
+                return primary.result()
+
+            if not self._may_hedge():
+                return await primary
+            hedge = asyncio.ensure_future(self._timed_call_async(contents, endpoint))
+            tasks.append(hedge)
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The loser, or both when our caller is cancelled; the governor
+            # gives their quota slots back
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        def ms(tracker, fraction):
+            value = tracker.percentile(fraction)
+            return None if value is None else round(value * 1000, 1)
+
+        return {
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+            "circuit_state": self.breaker.state,
+            "circuit_rejected": self.breaker.rejected,
+            "upstream_p95_ms": ms(self.upstream_latency, 0.95),
+            "upstream_p99_ms": ms(self.upstream_latency, 0.99),
+            "effective_p95_ms": ms(self.effective_latency, 0.95),
+            "effective_p99_ms": ms(self.effective_latency, 0.99),
+        }
@@ -0,0 +1,30 @@
+import re
+
+from metrics import span
+
+def clean_response_text(response_text):
+    # Drops markdown emphasis only; commas carry meaning ("1,000 ppm")
+    with span("clean_response"):
+        clean_text = re.sub(r'\*+', '', response_text)
+    return clean_text
+
+def response_chunks(response):
+    # Text of each chunk of a generate_content(..., stream=True) response
+    for chunk in response:
+        if chunk.text:
+            yield chunk.text
+
+def clean_response_chunks(chunks):
+    # The cleanup only drops single characters, so it is safe chunk by chunk
+    for chunk in chunks:
+        clean_chunk = clean_response_text(chunk)
+        if clean_chunk:
+            yield clean_chunk
+
+def collect_chunks(chunks, on_complete):
+    # Pass chunks through and hand the full text to on_complete at the end
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    on_complete("".join(parts))
@@ -0,0 +1,203 @@
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # optional: faster parsing, same results
+    orjson = None
+
+# Structured model output. Diagnoses and crop suggestions are requested as
+# JSON, validated here, cached in compact form and only rendered to text (with
+# labels in the user's language) at the edge.
+SEVERITIES = ("none", "mild", "moderate", "severe")
+
+DIAGNOSIS_SCHEMA = """{
+  "healthy": boolean,
+  "disease": string or null,
+  "confidence": number from 0 to 1,
+  "severity": "none" | "mild" | "moderate" | "severe",
+  "symptoms": [string],
+  "treatments": [string],
+  "prevention": [string],
+  "regional_context": string
+}"""
+
+CROPS_SCHEMA = """{
+  "crops": [{"name": string, "reasons": [string]}],
+  "notes": string
+}"""
+
+SCHEMAS = {"diagnosis": DIAGNOSIS_SCHEMA, "crops": CROPS_SCHEMA}
+
+class SchemaError(ValueError):
+    pass
+
+def json_instructions(schema, language="English"):
+    return (
+        "Respond with only a JSON object, no markdown, matching this schema:\n"
+        f"{schema}\n"
+        "Keep every list to at most 4 short items. "
+        f"Write all string values in {language}."
+    )
+
+def dumps_compact(value):
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+def parse_json(text):
+    # Models sometimes wrap JSON in a markdown fence despite being told not to
+    text = FENCE.sub("", text)
+    try:
+        value = orjson.loads(text) if orjson else json.loads(text)
+    except ValueError as e:
+        raise SchemaError(f"Model returned invalid JSON: {e}") from None
+    if not isinstance(value, dict):
+        raise SchemaError("Model returned JSON that is not an object")
+    return value
+
+def _string(value, field, optional=False):
+    if value is None and optional:
+        return None
+    if not isinstance(value, str):
+        raise SchemaError(f"'{field}' must be a string")
+    return value.strip()
+
+def _strings(value, field):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise SchemaError(f"'{field}' must be a list of strings")
+    return [_string(item, field) for item in value if item]
+
+def parse_diagnosis(text):
+    data = parse_json(text)
+    try:
+        confidence = min(1.0, max(0.0, float(data.get("confidence", 0))))
+    except (TypeError, ValueError):
+        raise SchemaError("'confidence' must be a number") from None
+    severity = str(data.get("severity", "")).strip().lower()
+    if severity not in SEVERITIES:
+        raise SchemaError(f"'severity' must be one of {', '.join(SEVERITIES)}")
+
+    disease = _string(data.get("disease"), "disease", optional=True) or None
+    return {
+        "healthy": bool(data.get("healthy", disease is None)),
+        "disease": disease,
+        "confidence": round(confidence, 2),
+        "severity": severity,
+        "symptoms": _strings(data.get("symptoms"), "symptoms"),
+        "treatments": _strings(data.get("treatments"), "treatments"),
+        "prevention": _strings(data.get("prevention"), "prevention"),
+        "regional_context": _string(data.get("regional_context") or "", "regional_context"),
+    }
+
+def parse_crops(text):
+    data = parse_json(text)
+    crops = data.get("crops")
+    if not isinstance(crops, list):
+        raise SchemaError("'crops' must be a list")
+
+    parsed = []
+    for crop in crops:
+        if not isinstance(crop, dict):
+            raise SchemaError("each crop must be an object")
+        parsed.append({
+            "name": _string(crop.get("name"), "name"),
+            "reasons": _strings(crop.get("reasons"), "reasons"),
+        })
+    return {"crops": parsed, "notes": _string(data.get("notes") or "", "notes")}
+
+# Section labels per UI language; field values come from the model already
+# in that language
+LABELS = {
+    "English": {
+        "disease": "Disease", "healthy": "No disease detected", "confidence": "Confidence",
+        "severity": "Severity", "symptoms": "Symptoms", "treatments": "Treatment",
+        "prevention": "Prevention", "regional_context": "Regional context",
+        "crops": "Recommended crops", "notes": "Notes",
+        "none": "none", "mild": "mild", "moderate": "moderate", "severe": "severe",
+    },
+    "Hindi": {
+        "disease": "रोग", "healthy": "कोई रोग नहीं पाया गया", "confidence": "विश्वास स्तर",
+        "severity": "गंभीरता", "symptoms": "लक्षण", "treatments": "उपचार",
+        "prevention": "रोकथाम", "regional_context": "क्षेत्रीय संदर्भ",
+        "crops": "अनुशंसित फसलें", "notes": "टिप्पणियाँ",
+        "none": "कोई नहीं", "mild": "हल्की", "moderate": "मध्यम", "severe": "गंभीर",
+    },
+    "Malayalam": {
+        "disease": "രോഗം", "healthy": "രോഗം കണ്ടെത്തിയില്ല", "confidence": "ഉറപ്പ്",
+        "severity": "തീവ്രത", "symptoms": "ലക്ഷണങ്ങൾ", "treatments": "ചികിത്സ",
+        "prevention": "പ്രതിരോധം", "regional_context": "പ്രാദേശിക പശ്ചാത്തലം",
+        "crops": "ശുപാർശ ചെയ്യുന്ന വിളകൾ", "notes": "കുറിപ്പുകൾ",
+        "none": "ഇല്ല", "mild": "നേരിയ", "moderate": "മിതമായ", "severe": "ഗുരുതരം",
+    },
+    "Tamil": {
+        "disease": "நோய்", "healthy": "நோய் எதுவும் கண்டறியப்படவில்லை", "confidence": "நம்பகத்தன்மை",
+        "severity": "தீவிரம்", "symptoms": "அறிகுறிகள்", "treatments": "சிகிச்சை",
+        "prevention": "தடுப்பு முறைகள்", "regional_context": "பிராந்திய சூழல்",
+        "crops": "பரிந்துரைக்கப்பட்ட பயிர்கள்", "notes": "குறிப்புகள்",
+        "none": "இல்லை", "mild": "லேசான", "moderate": "மிதமான", "severe": "கடுமையான",
+    },
+    "Telugu": {
+        "disease": "వ్యాధి", "healthy": "ఏ వ్యాధి కనుగొనబడలేదు", "confidence": "నమ్మకం",
+        "severity": "తీవ్రత", "symptoms": "లక్షణాలు", "treatments": "చికిత్స",
+        "prevention": "నివారణ", "regional_context": "ప్రాంతీయ సందర్భం",
+        "crops": "సిఫార్సు చేసిన పంటలు", "notes": "గమనికలు",
+        "none": "లేదు", "mild": "తేలికపాటి", "moderate": "మధ్యస్థ", "severe": "తీవ్రమైన",
+    },
+}
+
+def _section(lines, label, items):
+    if items:
+        lines.append("")
+        lines.append(f"{label}:")
+        lines.extend(f"- {item}" for item in items)
+
+def render_diagnosis(diagnosis, language="English"):
+    labels = LABELS.get(language, LABELS["English"])
+    if diagnosis["disease"]:
+        lines = [f"{labels['disease']}: {diagnosis['disease']}"]
+    else:
+        lines = [labels["healthy"]]
+    lines.append(f"{labels['confidence']}: {diagnosis['confidence']:.0%}")
+    lines.append(f"{labels['severity']}: {labels[diagnosis['severity']]}")
+    _section(lines, labels["symptoms"], diagnosis["symptoms"])
+    _section(lines, labels["treatments"], diagnosis["treatments"])
+    _section(lines, labels["prevention"], diagnosis["prevention"])
+    if diagnosis["regional_context"]:
+        lines.extend(["", f"{labels['regional_context']}: {diagnosis['regional_context']}"])
+    return "\n".join(lines)
+
+def render_crops(suggestions, language="English"):
+    labels = LABELS.get(language, LABELS["English"])
+    lines = [f"{labels['crops']}:"]
+    for crop in suggestions["crops"]:
+        reasons = "; ".join(crop["reasons"])
+        lines.append(f"- {crop['name']}: {reasons}" if reasons else f"- {crop['name']}")
+    if suggestions["notes"]:
+        lines.extend(["", f"{labels['notes']}: {suggestions['notes']}"])
+    return "\n".join(lines)
+
+def example_payload(kind, words):
+    # Schema-shaped filler for the offline fake backend
+    def phrase(start, count=3):
+        return " ".join(words[start:start + count])
+
+    if kind == "diagnosis":
+        return {
+            "healthy": False,
+            "disease": phrase(0, 2),
+            "confidence": round(0.5 + len(words[0]) / 40, 2),
+            "severity": SEVERITIES[len(words[1]) % len(SEVERITIES)],
+            "symptoms": [phrase(2), phrase(5)],
+            "treatments": [phrase(8), phrase(11), phrase(14)],
+            "prevention": [phrase(17), phrase(20)],
+            "regional_context": phrase(23, 12),
+        }
+    return {
+        "crops": [{"name": words[i], "reasons": [phrase(i + 1), phrase(i + 4)]} for i in range(0, 21, 7)],
+        "notes": phrase(21, 10),
+    }
@@ -1,111 +1,149 @@
-import os
-import re
-from pathlib import Path
+import io
 import json
-from flask import Flask, request, jsonify, render_template
-import google.generativeai as genai
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
+import os
+import core
+from flask import Flask, Request, Response, g, request, jsonify, render_template, stream_with_context, url_for
+import metrics
+from metrics import span, timed_iter
+from concurrency import CALL_TIMEOUT, executor, is_rate_limited, map_as_completed, merge_streams, run_concurrently
+from images import spooled_upload_stream
+from cache import image_cache_key
+from jobs import JobError, JobQueue
+from prescreen import ImageRejected
+from regional_store import REGIONAL_REFRESH, REGIONAL_TARGETS, load_targets
+from prompts import REGIONAL_INSIGHTS
+from resilience import CircuitOpenError, error_status
+from responses import clean_response_chunks, collect_chunks, response_chunks
+from structured import render_crops, render_diagnosis
+# The model calls themselves are shared with the other entry points
+from generation import (
+    DISEASE_PROMPT_VERSION, generate_disease_analysis, generate_regional_disease_insights,
+    generate_seasonal_insights, get_crop_suggestions, get_disease_diagnosis, get_regional_disease_insights,
+    model, precomputed_insights, regional_insights_prompt, regional_store
+)
 
 # Flask App Configuration
-app = Flask(__name__, static_folder='frontend', template_folder='frontend')
+class UploadRequest(Request):
+    # Keep uploads in memory; large ones, and every file of a large request,
+    # go to an anonymous temp file
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return spooled_upload_stream(total_content_length)
+
+    @staticmethod
+    def take_upload(upload):
+        # The upload's stream, now owned (and closed) by the caller: the
+        # request no longer closes it when it ends, so a streamed response
+        # can keep reading it without a copy
+        stream, upload.stream = upload.stream, io.BytesIO()
+        return stream
+
+# Whole request body, all files included; larger requests get a 413
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", 64 * 1024 * 1024))
+# Batch requests get their own limits, sized for a field survey: up to 200
+# photos of up to 12 MB each, spooled to disk (see images.py) and analysed a
+# few at a time
+BATCH_MAX_REQUEST_BYTES = int(os.getenv("BATCH_MAX_REQUEST_BYTES", 2560 * 1024 * 1024))
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 200))
 
-# Gemini API Configuration
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-generation_config = {
-    "temperature": 0.4,
-    "top_p": 1,
-    "top_k": 32,
-    "max_output_tokens": 4096,
-}
-
-safety_settings = [
-    {"category": f"HARM_CATEGORY_{category}", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-    for category in ["HARASSMENT", "HATE_SPEECH", "SEXUALLY_EXPLICIT", "DANGEROUS_CONTENT"]
-]
-
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
-    generation_config=generation_config,
-    safety_settings=safety_settings,
-)
+app = Flask(__name__, static_folder='frontend', template_folder='frontend')
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
-# Utility Functions (Directly copied from original script)
-def read_image_data(file_path):
-    image_path = Path(file_path)
-    if not image_path.exists():
-        raise FileNotFoundError(f"Could not find image: {image_path}")
-    return {"mime_type": "image/jpeg", "data": image_path.read_bytes()}
+# Durable queue behind the job endpoints; its database opens on first use
+job_queue = JobQueue()
 
-def clean_response_text(response_text):
-    clean_text = re.sub(r'[*,]+', '', response_text)
-    return clean_text
+# Workers keep the precomputed regional store fresh (see regional_store.py)
+if regional_store is not None and REGIONAL_TARGETS and REGIONAL_REFRESH:
+    regional_store.refresh_in_background(
+        load_targets(REGIONAL_TARGETS), lambda *target: generate_seasonal_insights(*target)
+    )
 
 # Core Functions (Directly from original script)
-def generate_disease_analysis(image_path, language, district, state, area):
-    input_prompt = f"""
-    As a highly skilled plant pathologist, analyze this plant image for a farmer in {area}, {district}, {state}. Please provide:
-    1. Disease identification (if any)
-    2. Severity assessment
-    3. Treatment recommendations
-    4. Regional context: Is this disease common in {district}? What factors in this region might affect its spread?
-    5. Preventive measures specific to this geographical area
-    
-    Consider local climate patterns and common agricultural practices in {state} when making recommendations.
-    Please be concise and practical in your response.
-    """
-    
-    language_prompt = f"Provide the following response in {language}: {input_prompt}"
-    image_data = read_image_data(image_path)
-    response = model.generate_content([language_prompt, image_data])
-    return clean_response_text(response.text)
-
-def get_regional_disease_insights(district, state, area):
-    prompt = f"""
-    As an agricultural expert, provide insights about plant diseases in {area}, {district}, {state}:
-    1. What are the most common plant diseases in this region?
-    2. Which seasons are these diseases most prevalent?
-    3. What are the unique environmental factors in {district} that affect plant health?
-    4. What preventive measures do you recommend for farmers in this specific area?
-    
-    Provide a concise, practical response focusing on local relevance.
-    """
-    
-    response = model.generate_content([prompt])
-    return clean_response_text(response.text)
-
-def get_crop_suggestions(soil_type, ph_level, nutrients, texture, location):
-    prompt = f"""
-    As an expert agricultural advisor, based on the following details:
-    - Soil Type: {soil_type}
-    - pH Level: {ph_level}
-    - Nutrient Content: {nutrients}
-    - Soil Texture: {texture}
-    - Location: {location}
-    
-    Suggest the best crops that can be planted in this region and soil type. 
-    Provide reasons for your suggestions, including compatibility with soil, climate, and market demand. 
-    Your response should be concise and farmer-friendly.
-    """
+def upstream_chunks(contents, endpoint=None):
+    # Opening the stream happens on first iteration, so timed_iter covers it
+    yield from response_chunks(model.generate_content(contents, stream=True, endpoint=endpoint))
+
+def stream_disease_analysis(image, language, district, state, area):
+    # A structured answer is only usable once complete, so it arrives whole
+    yield generate_disease_analysis(image, language, district, state, area)
+
+def stream_regional_disease_insights(district, state, area):
+    cached = precomputed_insights(district, state, area) or generate_regional_disease_insights.lookup(
+        district, state, area
+    )
+    if cached is not None:
+        yield cached
+        return
     
-    response = model.generate_content([prompt])
-    return response.text.strip()
+    chunks = timed_iter("regional_call", upstream_chunks(
+        [regional_insights_prompt(district, state, area)], endpoint=REGIONAL_INSIGHTS.endpoint
+    ))
+    yield from collect_chunks(
+        clean_response_chunks(chunks),
+        lambda insights: generate_regional_disease_insights.store(insights, district, state, area)
+    )
+
+def stream_crop_suggestions(soil_type, ph_level, nutrients, texture, location):
+    yield render_crops(get_crop_suggestions(soil_type, ph_level, nutrients, texture, location))
+
+# Streaming helpers
+def wants_event_stream():
+    return request.args.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def event_stream(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def upstream_error_response(errors):
+    messages = {name: str(e) for name, e in errors.items()}
+    body = jsonify({"error": "; ".join(messages.values()), "errors": messages})
+    status, headers = error_status(errors.values())
+    return body, status, headers
+
+# Per-request timing: stage spans recorded while serving a request are
+# reported together (METRICS_LOG=1) and feed the /metrics histograms
+@app.before_request
+def start_timing():
+    g.timing = metrics.start_request()
+
+@app.before_request
+def start_job_workers():
+    # Per process, on its first request, so queued jobs resume after a restart
+    job_queue.start_workers()
+
+@app.after_request
+def finish_timing(response):
+    # Streamed responses are timed up to their first byte
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.finish_request(g.pop('timing', None), route, response.status_code)
+    core.mark_first_request()
+    return response
 
 # Routes
 @app.route('/')
 def home():
     return render_template('index.html')
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/disease-detection', methods=['POST'])
 def disease_detection_api():
-    # Validate and process image upload
-    if 'image' not in request.files:
+    # Validate and process image upload; the multipart body is parsed on
+    # first access to request.files
+    with span("upload"):
+        files = request.files
+    if 'image' not in files:
         return jsonify({"error": "No image uploaded"}), 400
     
-    image = request.files['image']
+    image = files['image']
     
     # Collect additional parameters
     params = {
@@ -115,176 +153,157 @@ def disease_detection_api():
         'area': request.form.get('area', '')
     }
     
-    # Save temporary image
-    temp_path = f"/tmp/{image.filename}"
-    image.save(temp_path)
+    if wants_event_stream():
+        return stream_disease_detection(request.take_upload(image), params)
     
     try:
-        # Generate analyses
-        disease_analysis = generate_disease_analysis(
-            temp_path, 
+        results, errors = detect_disease(image.stream, params)
+        
+        rejected = errors.get("disease_analysis")
+        if isinstance(rejected, ImageRejected):
+            return jsonify({"error": str(rejected)}), 422
+        
+        if not results:
+            return upstream_error_response(errors)
+        
+        return jsonify(detection_result(results, errors, params['language']))
+    except Exception as e:
+        return upstream_error_response({"disease_analysis": e})
+
+def detect_disease(image, params):
+    # Generate both analyses concurrently; they don't depend on each other
+    return run_concurrently({
+        "disease_analysis": lambda: get_disease_diagnosis(
+            image, 
             params['language'], 
             params['district'], 
             params['state'], 
             params['area']
-        )
-        
-        regional_insights = get_regional_disease_insights(
+        ),
+        "regional_insights": lambda: get_regional_disease_insights(
             params['district'], 
             params['state'], 
             params['area']
-        )
-        
-        return jsonify({
-            "disease_analysis": disease_analysis,
-            "regional_insights": regional_insights
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        # Clean up temporary file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-
-@app.route('/api/crop-recommendation', methods=['POST'])
-def crop_recommendation_api():
-    # Get input data
-    data = request.json
-    
-    # Validate inputs
-    required_fields = ['soil_type', 'ph_level', 'nutrients', 'texture', 'location']
-    for field in required_fields:
-        if field not in data:
-            return jsonify({"error": f"Missing {field}"}), 400
+        ),
+    })
+
+def detection_result(results, errors, language):
+    diagnosis = results.get("disease_analysis")
+    response = {
+        "disease_analysis": render_diagnosis(diagnosis, language) if diagnosis else None,
+        "diagnosis": diagnosis,
+        "regional_insights": results.get("regional_insights")
+    }
+    if errors:
+        response["errors"] = {name: str(e) for name, e in errors.items()}
+    return response
+
+def stream_disease_detection(image, params):
+    # Both sections stream side by side as server-sent events
+    def generate():
+        try:
+            for name, chunk, error in merge_streams({
+                "disease_analysis": stream_disease_analysis(
+                    image, params['language'], params['district'], params['state'], params['area']
+                ),
+                "regional_insights": stream_regional_disease_insights(
+                    params['district'], params['state'], params['area']
+                ),
+            }):
+                if error:
+                    yield sse_event("error", {"section": name, "error": error})
+                else:
+                    yield sse_event(name, {"text": chunk})
+            yield sse_event("done", {})
+        finally:
+            image.close()
     
-    # Generate recommendations
-    recommendations = get_crop_suggestions(
-        data['soil_type'],
-        data['ph_level'],
-        data['nutrients'],
-        data['texture'],
-        data['location']
-    )
+    return event_stream(generate())
+
+@app.route('/api/disease-detection/batch', methods=['POST'])
+def disease_detection_batch_api():
+    # Set before the body is parsed on first access to request.files
+    request.max_content_length = BATCH_MAX_REQUEST_BYTES
+    images = request.files.getlist('images')
+    if not images:
+        return jsonify({"error": "No images uploaded"}), 400
+    if len(images) > BATCH_MAX_IMAGES:
+        return jsonify({"error": f"At most {BATCH_MAX_IMAGES} images per batch"}), 413
     
-    return jsonify({"recommendations": recommendations})
-
-# Error Handling
-@app.errorhandler(500)
-def handle_500(error):
-    return jsonify({"error": "Internal Server Error"}), 500
-
-# Main Entry Point
-if __name__ == '__main__':
-import os
-import re
-from pathlib import Path
-import json
-from flask import Flask, request, jsonify, render_template
-import google.generativeai as genai
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Flask App Configuration
-app = Flask(__name__, static_folder='frontend', template_folder='frontend')
-
-# Gemini API Configuration
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-generation_config = {
-    "temperature": 0.4,
-    "top_p": 1,
-    "top_k": 32,
-    "max_output_tokens": 4096,
-}
-
-safety_settings = [
-    {"category": f"HARM_CATEGORY_{category}", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-    for category in ["HARASSMENT", "HATE_SPEECH", "SEXUALLY_EXPLICIT", "DANGEROUS_CONTENT"]
-]
-
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
-    generation_config=generation_config,
-    safety_settings=safety_settings,
-)
-
-# Utility Functions (Directly copied from original script)
-def read_image_data(file_path):
-    image_path = Path(file_path)
-    if not image_path.exists():
-        raise FileNotFoundError(f"Could not find image: {image_path}")
-    return {"mime_type": "image/jpeg", "data": image_path.read_bytes()}
-
-def clean_response_text(response_text):
-    clean_text = re.sub(r'[*,]+', '', response_text)
-    return clean_text
-
-# Core Functions (Directly from original script)
-def generate_disease_analysis(image_path, language, district, state, area):
-    input_prompt = f"""
-    As a highly skilled plant pathologist, analyze this plant image for a farmer in {area}, {district}, {state}. Please provide:
-    1. Disease identification (if any)
-    2. Severity assessment
-    3. Treatment recommendations
-    4. Regional context: Is this disease common in {district}? What factors in this region might affect its spread?
-    5. Preventive measures specific to this geographical area
+    params = {
+        'language': request.form.get('language', 'English'),
+        'district': request.form.get('district', ''),
+        'state': request.form.get('state', ''),
+        'area': request.form.get('area', '')
+    }
     
-    Consider local climate patterns and common agricultural practices in {state} when making recommendations.
-    Please be concise and practical in your response.
-    """
+    # Regional insights are the same for every image, so fetch them once
+    regional_future = executor.submit(
+        get_regional_disease_insights, params['district'], params['state'], params['area']
+    )
     
-    language_prompt = f"Provide the following response in {language}: {input_prompt}"
-    image_data = read_image_data(image_path)
-    response = model.generate_content([language_prompt, image_data])
-    return clean_response_text(response.text)
-
-def get_regional_disease_insights(district, state, area):
-    prompt = f"""
-    As an agricultural expert, provide insights about plant diseases in {area}, {district}, {state}:
-    1. What are the most common plant diseases in this region?
-    2. Which seasons are these diseases most prevalent?
-    3. What are the unique environmental factors in {district} that affect plant health?
-    4. What preventive measures do you recommend for farmers in this specific area?
+    # Results keep streaming after the view returns; the generator below
+    # closes the uploads once it is done with them
+    uploads = [(image.filename, request.take_upload(image)) for image in images]
     
-    Provide a concise, practical response focusing on local relevance.
-    """
+    def analyse(upload):
+        return get_disease_diagnosis(
+            upload[1], params['language'], params['district'], params['state'], params['area']
+        )
     
-    response = model.generate_content([prompt])
-    return clean_response_text(response.text)
-
-def get_crop_suggestions(soil_type, ph_level, nutrients, texture, location):
-    prompt = f"""
-    As an expert agricultural advisor, based on the following details:
-    - Soil Type: {soil_type}
-    - pH Level: {ph_level}
-    - Nutrient Content: {nutrients}
-    - Soil Texture: {texture}
-    - Location: {location}
+    def regional_line():
+        try:
+            return {"regional_insights": regional_future.result(timeout=CALL_TIMEOUT)}
+        except Exception as e:
+            return {"regional_insights": None, "error": str(e)}
     
-    Suggest the best crops that can be planted in this region and soil type. 
-    Provide reasons for your suggestions, including compatibility with soil, climate, and market demand. 
-    Your response should be concise and farmer-friendly.
-    """
+    # Stream one JSON line per image as soon as it finishes
+    def generate():
+        regional_sent = False
+        failed = 0
+        try:
+            for index, diagnosis, error in map_as_completed(analyse, uploads):
+                line = {"index": index, "filename": uploads[index][0]}
+                if error:
+                    failed += 1
+                    line["error"] = error
+                else:
+                    line["disease_analysis"] = render_diagnosis(diagnosis, params['language'])
+                    line["diagnosis"] = diagnosis
+                yield json.dumps(line) + "\n"
+                
+                if not regional_sent and regional_future.done():
+                    regional_sent = True
+                    yield json.dumps(regional_line()) + "\n"
+            
+            if not regional_sent:
+                yield json.dumps(regional_line()) + "\n"
+            yield json.dumps({"done": True, "count": len(uploads), "failed": failed}) + "\n"
+        finally:
+            for _, stream in uploads:
+                stream.close()
     
-    response = model.generate_content([prompt])
-    return response.text.strip()
-
-# Routes
-@app.route('/')
-def home():
-    return render_template('index.html')
-
-@app.route('/api/disease-detection', methods=['POST'])
-def disease_detection_api():
-    # Validate and process image upload
-    if 'image' not in request.files:
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Job mode (see jobs.py): the upload is stored and answered with a job id at
+# once, so a dropped connection loses neither the result nor the model spend
+def run_detection_job(params, image_bytes):
+    results, errors = detect_disease(image_bytes, params)
+    if "disease_analysis" in errors:
+        # Retried by the queue; regional insights are memoized meanwhile
+        raise errors["disease_analysis"]
+    return detection_result(results, errors, params['language'])
+
+job_queue.register("disease-detection", run_detection_job, permanent_errors=(ImageRejected,))
+
+@app.route('/api/disease-detection/jobs', methods=['POST'])
+def disease_detection_job_api():
+    with span("upload"):
+        files = request.files
+    if 'image' not in files:
         return jsonify({"error": "No image uploaded"}), 400
     
-    image = request.files['image']
-    
-    # Collect additional parameters
+    image_bytes = files['image'].read()
     params = {
         'language': request.form.get('language', 'English'),
         'district': request.form.get('district', ''),
@@ -292,36 +311,29 @@ def disease_detection_api():
         'area': request.form.get('area', '')
     }
     
-    # Save temporary image
-    temp_path = f"/tmp/{image.filename}"
-    image.save(temp_path)
-    
+    # Resubmitting the same image and parameters returns the existing job
+    dedup_key = image_cache_key(
+        image_bytes, params['language'], params['district'], params['state'], params['area'],
+        DISEASE_PROMPT_VERSION
+    )
     try:
-        # Generate analyses
-        disease_analysis = generate_disease_analysis(
-            temp_path, 
-            params['language'], 
-            params['district'], 
-            params['state'], 
-            params['area']
+        job, created = job_queue.submit(
+            "disease-detection", params, image_bytes, dedup_key, request.form.get('callback_url')
         )
-        
-        regional_insights = get_regional_disease_insights(
-            params['district'], 
-            params['state'], 
-            params['area']
-        )
-        
-        return jsonify({
-            "disease_analysis": disease_analysis,
-            "regional_insights": regional_insights
-        })
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        # Clean up temporary file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    except JobError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    status_url = url_for('job_status_api', job_id=job['job_id'])
+    return jsonify({**job, "deduplicated": not created, "status_url": status_url}), 202, {'Location': status_url}
+
+@app.route('/api/jobs/<job_id>')
+def job_status_api(job_id):
+    # ?wait=N long-polls up to N seconds (at most JOB_MAX_WAIT) for the result
+    wait = request.args.get('wait', type=float)
+    job = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
 
 @app.route('/api/crop-recommendation', methods=['POST'])
 def crop_recommendation_api():
@@ -334,22 +346,51 @@ def crop_recommendation_api():
         if field not in data:
             return jsonify({"error": f"Missing {field}"}), 400
     
+    if wants_event_stream():
+        def generate():
+            try:
+                for chunk in stream_crop_suggestions(
+                    data['soil_type'], data['ph_level'], data['nutrients'], data['texture'], data['location']
+                ):
+                    yield sse_event("recommendations", {"text": chunk})
+            except Exception as e:
+                yield sse_event("error", {"error": str(e)})
+            yield sse_event("done", {})
+        
+        return event_stream(generate())
+    
     # Generate recommendations
-    recommendations = get_crop_suggestions(
-        data['soil_type'],
-        data['ph_level'],
-        data['nutrients'],
-        data['texture'],
-        data['location']
-    )
+    try:
+        suggestions = get_crop_suggestions(
+            data['soil_type'],
+            data['ph_level'],
+            data['nutrients'],
+            data['texture'],
+            data['location']
+        )
+    except Exception as e:
+        if not (is_rate_limited(e) or isinstance(e, CircuitOpenError)):
+            raise
+        return upstream_error_response({"recommendations": e})
     
-    return jsonify({"recommendations": recommendations})
+    return jsonify({
+        "recommendations": render_crops(suggestions),
+        "crops": suggestions["crops"],
+        "notes": suggestions["notes"]
+    })
 
 # Error Handling
 @app.errorhandler(500)
 def handle_500(error):
     return jsonify({"error": "Internal Server Error"}), 500
 
+@app.errorhandler(413)
+def handle_413(error):
+    limit = request.max_content_length or MAX_REQUEST_BYTES
+    return jsonify({"error": f"Upload too large; at most {limit // (1024 * 1024)} MB per request"}), 413
+
+core.mark("app_ready")
+
 # Main Entry Point
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
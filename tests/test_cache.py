@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from cache import LRUCache, SQLiteCache
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteCache(str(tmp_path / "cache.sqlite3"))
+    return LRUCache()
+
+def test_concurrent_async_callers_share_one_computation(cache):
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return "diagnosis"
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get_or_compute_async("key", compute) for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["diagnosis"] * 5
+    assert calls == 1
+    assert cache.get("key") == "diagnosis"
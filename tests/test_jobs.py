@@ -0,0 +1,120 @@
+import http.server
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import DONE, JobError, JobQueue, post_callback, validate_callback_url
+
+@pytest.fixture(autouse=True)
+def public_callbacks_only(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_CALLBACK_HOSTS", set())
+    monkeypatch.setattr(jobs, "JOB_CALLBACK_ALLOW_PRIVATE", False)
+    monkeypatch.setattr(jobs, "JOB_CALLBACK_SECRET", None)
+
+def fake_dns(monkeypatch, *answers):
+    # Each lookup returns the next answer, as a rebinding DNS server would
+    lookups = []
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        lookups.append(host)
+        address = answers[min(len(lookups), len(answers)) - 1]
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, port or 80))]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    return lookups
+
+def make_queue(tmp_path, **kwargs):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), workers=0, **kwargs)
+    queue.register("echo", lambda params, payload: params)
+    return queue
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/hook",
+    "http://10.1.2.3/hook",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/hook",
+    "http://[::ffff:192.168.0.1]/hook",
+    "ftp://93.184.216.34/hook",
+])
+def test_private_and_non_http_callbacks_are_rejected(url):
+    with pytest.raises(JobError):
+        validate_callback_url(url)
+
+def test_host_resolving_to_a_private_address_is_rejected(monkeypatch):
+    fake_dns(monkeypatch, "192.168.1.10")
+    with pytest.raises(JobError):
+        validate_callback_url("https://hooks.example.com/plantpal")
+
+def test_callback_connects_to_the_address_that_was_checked(monkeypatch):
+    # The second lookup would rebind the name to loopback
+    lookups = fake_dns(monkeypatch, "93.184.216.34", "127.0.0.1")
+    connected = []
+
+    def create_connection(address, *args, **kwargs):
+        connected.append(address)
+        raise ConnectionRefusedError
+
+    monkeypatch.setattr(socket, "create_connection", create_connection)
+    with pytest.raises(ConnectionRefusedError):
+        post_callback("http://hooks.example.com/plantpal", {"job_id": "1"})
+    assert lookups == ["hooks.example.com"]
+    assert connected == [("93.184.216.34", 80)]
+
+def test_pinned_callback_keeps_the_host_header(monkeypatch):
+    received = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received["host"] = self.headers["Host"]
+            received["path"] = self.path
+            received["body"] = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.handle_request, daemon=True).start()
+    port = server.server_address[1]
+    fake_dns(monkeypatch, "127.0.0.1")
+    monkeypatch.setattr(jobs, "is_public_address", lambda address: True)
+    try:
+        post_callback(f"http://hooks.example.com:{port}/plantpal?token=abc", {"job_id": "1"})
+    finally:
+        server.server_close()
+    assert received == {
+        "host": f"hooks.example.com:{port}", "path": "/plantpal?token=abc", "body": {"job_id": "1"},
+    }
+
+def test_each_deduplicated_submitter_keeps_its_callback(tmp_path):
+    queue = make_queue(tmp_path)
+    first, created = queue.submit("echo", {"n": 1}, dedup_key="same", callback_url="http://93.184.216.34/a")
+    assert created
+    again, created = queue.submit("echo", {"n": 1}, dedup_key="same", callback_url="http://93.184.216.34/b")
+    assert not created and again["job_id"] == first["job_id"]
+    # A retry from the same submitter doesn't add a second callback
+    queue.submit("echo", {"n": 1}, dedup_key="same", callback_url="http://93.184.216.34/a")
+
+    rows = queue._connection().execute(
+        "SELECT url FROM job_callbacks WHERE job_id = ? ORDER BY url", (first["job_id"],)
+    ).fetchall()
+    assert rows == [("http://93.184.216.34/a",), ("http://93.184.216.34/b",)]
+
+def test_job_of_a_dead_worker_is_taken_over_after_its_lease(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=0.2)
+    job, _ = queue.submit("echo", {"n": 1})
+    # A worker claims the job and dies without finishing it
+    assert queue._claim()[0] == job["job_id"]
+    assert not queue.run_one()
+
+    time.sleep(0.3)
+    assert queue.run_one()
+    finished = queue.get(job["job_id"])
+    assert finished["status"] == DONE
+    assert finished["attempts"] == 2
+    assert finished["result"] == {"n": 1}
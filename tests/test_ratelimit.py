@@ -0,0 +1,64 @@
+import asyncio
+
+from backends import GovernedBackend
+from ratelimit import AdaptiveConcurrency, RateGovernor
+
+class SlowBackend:
+    def __init__(self, delay=10):
+        self.delay = delay
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        return iter(["a", "b"]) if stream else "ok"
+
+    async def generate_content_async(self, contents, endpoint=None):
+        await asyncio.sleep(self.delay)
+        return "ok"
+
+def make_governor(limit=1):
+    return RateGovernor(concurrency=AdaptiveConcurrency(initial=limit, minimum=1, maximum=limit))
+
+def test_cancelled_waiter_leaves_the_queue():
+    governor = make_governor()
+
+    async def scenario():
+        await governor.acquire_async(1)
+        waiter = asyncio.ensure_future(governor.acquire_async(1))
+        await asyncio.sleep(0.1)
+        assert governor.stats()["queued"] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert governor.stats()["queued"] == 0
+        governor.release()
+        # The next caller is admitted rather than stuck behind a dead ticket
+        await asyncio.wait_for(governor.acquire_async(1), timeout=1)
+
+    asyncio.run(scenario())
+    assert governor.stats()["in_flight"] == 1
+
+def test_cancelled_call_releases_its_slot():
+    governor = make_governor()
+    backend = GovernedBackend(SlowBackend(), governor)
+
+    async def scenario():
+        call = asyncio.ensure_future(backend.generate_content_async(["prompt"]))
+        await asyncio.sleep(0.1)
+        assert governor.stats()["in_flight"] == 1
+        call.cancel()
+        await asyncio.gather(call, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert governor.stats()["in_flight"] == 0
+
+def test_stream_holds_its_slot_until_drained():
+    governor = make_governor()
+    backend = GovernedBackend(SlowBackend(), governor)
+
+    response = backend.generate_content(["prompt"], stream=True)
+    assert governor.stats()["in_flight"] == 1
+    assert list(response) == ["a", "b"]
+    assert governor.stats()["in_flight"] == 0
+
+    abandoned = iter(backend.generate_content(["prompt"], stream=True))
+    next(abandoned)
+    abandoned.close()
+    assert governor.stats()["in_flight"] == 0
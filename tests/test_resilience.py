@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import pytest
+
+import resilience
+from backends import GovernedBackend
+from ratelimit import AdaptiveConcurrency, RateGovernor, RateLimitExceeded
+from resilience import CircuitBreaker, CircuitOpenError, HedgeBudget, ResilientBackend, error_status
+
+def test_hedge_budget_caps_hedges_to_a_fraction_of_calls():
+    budget = HedgeBudget(ratio=0.05, burst=2)
+    hedged = 0
+    for _ in range(1000):
+        budget.on_call()
+        hedged += budget.try_spend()
+    assert hedged <= 2 + 1000 * 0.05
+
+def test_error_status_sends_retry_after_with_429_and_503():
+    assert error_status([RateLimitExceeded(2.5), RateLimitExceeded(7)]) == (429, {"Retry-After": "7"})
+    assert error_status([CircuitOpenError(12)]) == (503, {"Retry-After": "12"})
+    assert error_status([CircuitOpenError(12), ValueError("bad answer")]) == (500, {})
+
+class ScriptedBackend:
+    # Async calls take the next delay in turn; cancelled calls are counted
+    def __init__(self, *delays, error=None):
+        self.delays = list(delays)
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+
+    def generate_content(self, contents, stream=False, endpoint=None):
+        self.calls += 1
+        raise self.error
+
+    async def generate_content_async(self, contents, endpoint=None):
+        delay = self.delays[self.calls] if self.calls < len(self.delays) else 0
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return "ok"
+
+def test_async_hedge_cancels_the_loser_and_frees_its_slot(monkeypatch):
+    monkeypatch.setattr(resilience, "HEDGE", True)
+    monkeypatch.setattr(resilience, "HEDGE_MIN_DELAY", 0.05)
+    stub = ScriptedBackend(10, 0)
+    governor = RateGovernor(concurrency=AdaptiveConcurrency(initial=2, minimum=1, maximum=2))
+    backend = ResilientBackend(GovernedBackend(stub, governor))
+    for _ in range(resilience.HEDGE_MIN_SAMPLES):
+        backend.upstream_latency.add(0.01)
+
+    async def scenario():
+        assert await asyncio.wait_for(backend.generate_content_async(["prompt"]), timeout=5) == "ok"
+        # Checked before asyncio.run would cancel a leftover primary itself
+        await asyncio.sleep(0.05)
+        assert (stub.calls, stub.cancelled) == (2, 1)
+        assert governor.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+    assert (backend.hedges, backend.hedge_wins) == (1, 1)
+
+def test_half_open_breaker_lets_a_single_probe_through():
+    breaker = CircuitBreaker(failures=1, reset_after=0.1)
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.15)
+    breaker.before_call()
+    assert breaker.state == "half-open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # A failed probe opens the circuit again, a successful one closes it
+    breaker.record_failure()
+    assert breaker.state == "open"
+    time.sleep(0.15)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+    breaker.before_call()
+
+def test_rate_limited_calls_are_not_retried():
+    stub = ScriptedBackend(error=RateLimitExceeded(5))
+    backend = ResilientBackend(stub)
+    with pytest.raises(RateLimitExceeded):
+        backend.generate_content(["prompt"])
+    with pytest.raises(RateLimitExceeded):
+        asyncio.run(backend.generate_content_async(["prompt"]))
+    assert stub.calls == 2
+    assert backend.retries == 0
+    # Our own quota says nothing about the upstream's health
+    assert backend.breaker.state == "closed" and backend.breaker.failures == 0
@@ -0,0 +1,66 @@
+import os
+
+from backends import get_backend
+from cache import cache_from_env, memoize, normalize_text
+from metrics import span
+from prompts import TRANSLATION
+from structured import DIAGNOSIS_SCHEMA, dumps_compact, json_instructions, parse_diagnosis
+
+# Translate-once pipeline: an image is analysed a single time in
+# CANONICAL_LANGUAGE, and other languages are produced from that answer by a
+# cheap text-only call, so every language shares one vision call and one
+# diagnosis cache entry. TRANSLATE_ONCE=0 asks the vision call for the user's
+# language directly instead.
+TRANSLATE_ONCE = os.getenv("TRANSLATE_ONCE", "1") != "0"
+CANONICAL_LANGUAGE = os.getenv("CANONICAL_LANGUAGE", "English")
+
+# Translations are keyed on (canonical answer, target language)
+translation_cache = cache_from_env("TRANSLATION_CACHE")
+
+def analysis_language(language):
+    # Language to request from the vision call
+    return CANONICAL_LANGUAGE if TRANSLATE_ONCE else language
+
+def is_canonical(language):
+    return normalize_text(language) == normalize_text(CANONICAL_LANGUAGE)
+
+def translation_prompt(diagnosis_json, language):
+    return TRANSLATION.render(
+        source_language=CANONICAL_LANGUAGE, language=language, diagnosis_json=diagnosis_json,
+        json_instructions=json_instructions(DIAGNOSIS_SCHEMA, language),
+    )
+
+def localized_diagnosis(canonical, translated):
+    # Only text is translated; the assessment itself stays the canonical one
+    return {
+        **translated,
+        "healthy": canonical["healthy"],
+        "disease": translated["disease"] if canonical["disease"] else None,
+        "confidence": canonical["confidence"],
+        "severity": canonical["severity"],
+    }
+
+@memoize(
+    translation_cache,
+    "diagnosis-translation-v1",
+    lambda diagnosis_json, language: (diagnosis_json, normalize_text(language)),
+)
+def translate_diagnosis_json(diagnosis_json, language):
+    response = get_backend().generate_content(
+        [translation_prompt(diagnosis_json, language)], endpoint=TRANSLATION.endpoint
+    )
+    return parse_diagnosis(response.text)
+
+def needs_translation(diagnosis, language):
+    # Templated answers (e.g. the pre-screen's) have no free text to translate
+    has_text = diagnosis["disease"] or diagnosis["regional_context"] or any(
+        diagnosis[field] for field in ("symptoms", "treatments", "prevention")
+    )
+    return TRANSLATE_ONCE and has_text and not is_canonical(language)
+
+def translate_diagnosis(diagnosis, language):
+    if not needs_translation(diagnosis, language):
+        return diagnosis
+    with span("translate_call"):
+        translated = translate_diagnosis_json(dumps_compact(diagnosis), language)
+    return localized_diagnosis(diagnosis, translated)
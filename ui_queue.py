@@ -0,0 +1,34 @@
+import os
+
+# Event queue settings shared by the Gradio apps. Handlers are grouped by the
+# kind of upstream call they make, and each group (a Gradio concurrency_id)
+# has its own limit, so a burst of slow vision calls can't hold up quick text
+# answers and neither can overload the upstream. Once UI_QUEUE_MAX_SIZE
+# events are waiting, new ones are rejected straight away ("queue is full")
+# instead of waiting minutes; queued users see their position, updated every
+# UI_STATUS_UPDATE_RATE seconds ("auto": whenever it changes).
+UI_QUEUE_MAX_SIZE = int(os.getenv("UI_QUEUE_MAX_SIZE", 64))
+UI_STATUS_UPDATE_RATE = os.getenv("UI_STATUS_UPDATE_RATE", "auto")
+
+# Concurrent events per group, e.g. UI_VISION_CONCURRENCY=2
+GROUP_LIMITS = {
+    "vision": int(os.getenv("UI_VISION_CONCURRENCY", 4)),
+    "text": int(os.getenv("UI_TEXT_CONCURRENCY", 8)),
+}
+
+def event_limits(group):
+    # Keyword arguments for an event listener, e.g. button.click(fn, **event_limits("text"))
+    return {"concurrency_limit": GROUP_LIMITS[group], "concurrency_id": group}
+
+def configure_queue(demo):
+    status_update_rate = UI_STATUS_UPDATE_RATE if UI_STATUS_UPDATE_RATE == "auto" else float(UI_STATUS_UPDATE_RATE)
+    return demo.queue(
+        max_size=UI_QUEUE_MAX_SIZE,
+        status_update_rate=status_update_rate,
+        # Listeners without a group run one at a time
+        default_concurrency_limit=1,
+    )
+
+def launch_options():
+    # Enough worker threads for every group to run at its limit at once
+    return {"max_threads": sum(GROUP_LIMITS.values()) + 4}